@@ -22,22 +22,42 @@ import logging
 logger = logging.getLogger("card")
 logger.setLevel(logging.INFO)
 
+import atexit
+import collections
+import functools
+import hashlib
+import itertools
+import mmap
 import queue
 import multiprocessing
-import multiprocessing.queues
+import pickle
 import re
 import string
 import sys
+import time
 
 import progressbar.bar
 import progressbar.widgets
 
+import data
+import index
+import keywords
+# Imported before shutdown_pool is registered below, so that the log writer
+# is stopped after the pool (atexit handlers run in reverse order), and
+# records sent by workers as they shut down are still written.
+import logs
+
 abil = re.compile(r'"[^"]+"')
 splitname = re.compile(r'([^/]+) // ([^()]+) \((\1|\2)\)')
 flipname = re.compile(r'([^()]+) \(([^()]+)\)')
 nonwords = re.compile(r'\W', flags=re.UNICODE)
 name_ref = re.compile(r'named |name is still |transforms into ')
 rarities = {'C', 'U', 'R', 'M', 'L', 'S'}
+colors = ('W', 'U', 'B', 'R', 'G')
+color_names = ('white', 'blue', 'black', 'red', 'green')
+card_types = ('artifact', 'creature', 'enchantment', 'instant', 'land',
+              'planeswalker', 'sorcery', 'tribal')
+supertypes = ('basic', 'legendary', 'snow', 'world', 'ongoing')
 
 all_names = {}
 all_names_inv = {}
@@ -45,6 +65,18 @@ all_shortnames = {}
 cards_by_set = {}
 _all_cards = {}
 expect_multi = {}
+# Built on demand by text_index().
+_text_index = None
+# Set by open_store(), for get_card to build cards from.
+_card_store = None
+# Cards by integer id, in the order they were created, and the reverse.
+_card_list = []
+_card_ids = {}
+# Card ids by value, for each kind of value; built on demand by
+# card_indexes(). See card_bits().
+_card_indexes = None
+_index_kinds = ('set', 'set_rarity', 'rarity', 'supertype', 'type',
+                'subtype', 'color', 'multitype')
 
 # Handle any Legendary names we couldn't get with ", " or " the ", most of
 # which have two words only, eg. Arcades Sabboth, or "of the".
@@ -149,27 +181,51 @@ def make_shortname(name):
             return name[:name.index(' the ')].strip()
     return shortname_exceptions.get(name)
 
+def _intern(s):
+    return s and sys.intern(s)
+
+_setslot = object.__setattr__
+
 class Card(object):
-    """ Stores information about a Magic card, as given by Gatherer. """
+    """ Stores information about a Magic card, as given by Gatherer.
+
+        The Gatherer fields are stored in slots. Strings that many cards
+        share (typelines, costs, colors and set codes) are interned. Any
+        other attribute set on a Card (eg. the parsed_* results of
+        demystify.parse_helper) goes in its __dict__, which is only made
+        when the first one is set. """
+    _fields = ('name', 'shortname', 'typeline', 'cost', 'color', 'pt',
+               'rules', 'sets', 'set_rarities', 'multitype', 'multicard')
+    __slots__ = _fields + ('__dict__',)
+
     def __init__(self, name, typeline, cost=None, color=None,
                  pt=None, rules=None, set_rarity=None,
                  multitype=None, multicard=None):
-        self.name = str(name)
-        self.typeline = str(typeline.lower())
-        self.cost = cost
-        self.color = color
-        self.pt = pt
-        self.rules = str(rules)
-        self.sets = set()
+        name = str(name)
+        sets = {}
         for s_r in set_rarity.split(', '):
             s, r = s_r.split('-', 1)
-            self.sets.add(s)
+            sets.setdefault(sys.intern(s), sys.intern(r))
             if r not in rarities:
                 logger.error("Unknown set_rarity entry for {}: {}"
                              .format(name, s_r))
-        self.sets = sorted(self.sets)
-        self.multitype = multitype
-        self.multicard = multicard
+        setnames = sorted(sets)
+        shortname = None
+        if 'Legendary' in typeline:
+            shortname = str(make_shortname(name))
+        # Going through Card.__setattr__ for every slot would make creating
+        # cards half again as slow.
+        _setslot(self, 'name', name)
+        _setslot(self, 'shortname', shortname)
+        _setslot(self, 'typeline', sys.intern(typeline.lower()))
+        _setslot(self, 'cost', _intern(cost))
+        _setslot(self, 'color', _intern(color))
+        _setslot(self, 'pt', _intern(pt))
+        _setslot(self, 'rules', str(rules))
+        _setslot(self, 'sets', setnames)
+        _setslot(self, 'set_rarities', tuple(sets[s] for s in setnames))
+        _setslot(self, 'multitype', _intern(multitype))
+        _setslot(self, 'multicard', multicard)
         if (self.multitype and not self.multicard
             or self.multicard and not self.multitype):
             logger.error('Malformed multicard: {} is a {} card to {}.'
@@ -189,18 +245,30 @@ class Card(object):
                              .format(self.name, self.multicard,
                                      mc.name, mc.multicard))
 
-        self.shortname = None
-        if 'Legendary' in typeline:
-            self.shortname = str(make_shortname(self.name))
-            if self.shortname:
-                logger.debug("Shortname for {} set to {}."
-                             .format(self.name, self.shortname))
-                all_shortnames[self.shortname] = self.name
+        if shortname:
+            logger.debug("Shortname for %s set to %s.", name, shortname)
+            all_shortnames[shortname] = name
 
         uname = construct_uname(self.name)
         all_names[self.name] = uname
         all_names_inv[uname] = self.name
+        if self.name in _card_ids:
+            i = _card_ids[self.name]
+            if _card_indexes is not None:
+                for kind, values in _index_values(_all_cards[self.name]):
+                    _card_indexes[kind].remove(i, values)
+            _card_list[i] = self
+        else:
+            i = _card_ids[self.name] = len(_card_list)
+            _card_list.append(self)
+        if _card_indexes is not None:
+            for kind, values in _index_values(self):
+                _card_indexes[kind].add(i, values)
         _all_cards[self.name] = self
+        if _name_trie is not None:
+            _name_trie.add(self.name)
+        if _text_index is not None:
+            _text_index.add_card(self.name, self.rules)
 
         for s in self.sets:
             if s not in cards_by_set:
@@ -219,7 +287,7 @@ class Card(object):
             if l.startswith("Name:"):
                 name = str(l[5:].strip())
                 if name in _all_cards:
-                    logger.debug("Previously saw {}.".format(name))
+                    logger.debug("Previously saw %s.", name)
                     return _all_cards[name]
             elif l.startswith("Cost:"):
                 kwargs['cost'] = l[5:].strip()
@@ -240,9 +308,18 @@ class Card(object):
         assert name is not None
         assert typeline is not None
         kwargs['rules'] = '\n'.join(rules)
-        logger.debug("Loaded {}.".format(name))
+        logger.debug("Loaded %s.", name)
         return Card(name, typeline, **kwargs)
 
+    @staticmethod
+    def load_all(files=None):
+        """ Yields a Card for each card in the data files (see data.scan),
+            as soon as it is created. As with from_string, a card whose name
+            was already seen is yielded as the existing Card. """
+        for name, typeline, kwargs in data.scan(files):
+            c = _all_cards.get(name)
+            yield c or Card(name, typeline, **kwargs)
+
     def __eq__(self, c):
         return type(self) == type(c) and self.name == c.name
 
@@ -252,12 +329,66 @@ class Card(object):
     def __hash__(self):
         return self.name.__hash__()
 
+    def __setattr__(self, attr, value):
+        object.__setattr__(self, attr, value)
+        if (attr == 'rules' and _text_index is not None
+            and _all_cards.get(self.name) is self):
+            _text_index.add_card(self.name, value)
+
+    def __getstate__(self):
+        # Slots by name, so that a state is read back into the same slots
+        # whatever their order. (Pickle writes each name once per pickle.)
+        return ({a: getattr(self, a, None) for a in Card._fields},
+                vars(self) or None)
+
+    def __setstate__(self, state):
+        values, extras = state
+        for a, v in values.items():
+            _setslot(self, a, v)
+        if extras:
+            vars(self).update(extras)
+
+    def get_colors(self):
+        """ Returns the colors ('W', 'U', etc.) of the mana symbols in this
+            card's cost and of its color indicator, if any. """
+        cs = set(self.cost or '')
+        if self.color:
+            for name in self.color.lower().split('/'):
+                if name in color_names:
+                    cs.add(colors[color_names.index(name)])
+        return tuple(c for c in colors if c in cs)
+
+    def get_types(self):
+        """ Returns (supertypes, types, subtypes), each a tuple of the
+            words from this card's typeline. Subtypes are only those in
+            keywords.subtypes. """
+        main, _, sub = self.typeline.partition(' — ')
+        words = main.split()
+        return (tuple(w for w in words if w in supertypes),
+                tuple(w for w in words if w in card_types),
+                tuple(w for w in sub.split() if w in keywords.subtypes))
+
+    def rarity(self, setname):
+        """ Returns this card's rarity in the given set, or None if it
+            wasn't printed there. """
+        try:
+            return self.set_rarities[self.sets.index(setname)]
+        except ValueError:
+            return None
+
+    def fields(self):
+        """ Returns a dict of this card's attributes, the Gatherer fields
+            and any others set on it. """
+        v = {a: getattr(self, a, None) for a in Card._fields}
+        v.update(vars(self))
+        return v
+
     def __repr__(self):
         return ('<{0.__module__}.{0.__name__} instance {1}>'
-                .format(self.__class__, vars(self)))
+                .format(self.__class__, self.fields()))
 
     def __str__(self):
-        v = vars(self)
+        v = self.fields()
         s = []
         for c in ['name', 'shortname', 'cost', 'color', 'typeline', 'pt',
                   'sets', 'rules', 'multitype', 'multicard']:
@@ -275,70 +406,372 @@ class CardWidget(progressbar.widgets.WidgetBase):
         else:
             return self.current_card[:16]
 
+def _card_progress_bar(n):
+    """ Starts a progress bar for n cards, and returns it along with the
+        CardWidget that displays the current card. """
+    cw = CardWidget()
+    widgets = [cw, ' ', progressbar.widgets.Bar(left='[', right=']'), ' ',
+               progressbar.widgets.SimpleProgress(), ' ', progressbar.widgets.ETA()]
+    pbar = progressbar.bar.ProgressBar(widgets=widgets, max_value=n)
+    pbar.start()
+    return pbar, cw
+
 class CardProgressBar(list):
     """ A list-like object that writes a progress bar to stdout
         when iterated over. """
     def __iter__(self):
         """ A generator that writes a progress bar to stdout as its elements
             are accessed. """
-        widgets = [CardWidget(), ' ', progressbar.widgets.Bar(left='[', right=']'), ' ',
-                   progressbar.widgets.SimpleProgress(), ' ', progressbar.widgets.ETA()]
-        pbar = progressbar.bar.ProgressBar(widgets=widgets, max_value=len(self))
-        pbar.start()
+        pbar, cw = _card_progress_bar(len(self))
         for i, card in enumerate(super(CardProgressBar, self).__iter__()):
-            widgets[0].current_card = card.name
+            cw.current_card = card.name
             pbar.update(i)
             yield card
         pbar.finish()
 
+def _index_values(c):
+    """ Yields each kind of _card_indexes with the values a card has. """
+    sup, typ, sub = c.get_types()
+    yield 'set', c.sets
+    yield 'set_rarity', [s + '-' + r for s, r in zip(c.sets, c.set_rarities)]
+    yield 'rarity', set(c.set_rarities)
+    yield 'supertype', sup
+    yield 'type', typ
+    yield 'subtype', set(sub)
+    yield 'color', c.get_colors()
+    if c.multitype:
+        yield 'multitype', (c.multitype.lower(),)
+
 ## Multiprocessing support for card-related tasks
 
-class CardProgressQueue(multiprocessing.queues.JoinableQueue):
-    def __init__(self, cards):
-        super(CardProgressQueue, self).__init__(
-                len(cards), ctx=multiprocessing.get_context())
-        self._cw = CardWidget()
-        widgets = [self._cw, ' ', progressbar.widgets.Bar(left='[', right=']'), ' ',
-                   progressbar.widgets.SimpleProgress(), ' ', progressbar.widgets.ETA()]
-        self._pbar = progressbar.bar.ProgressBar(widgets=widgets, max_value=len(cards))
-        self._pbar.start()
-        for c in cards:
-            self.put(c)
-
-    def task_done(self, cname=None):
-        with self._cond:
-            if not self._unfinished_tasks.acquire(False):
-                raise ValueError('task_done() called too many times')
-            self._cw.current_card = cname or ' '
-            if self._unfinished_tasks._semlock._is_zero():
-                self._pbar.finish()
-                self._cond.notify_all()
-            else:
-                self._pbar.update(self._sem._semlock._get_value())
+def _func_name(func):
+    return getattr(func, '__name__', None) or repr(func)
 
-def _card_worker(work_queue, res_queue, func):
-    logger.debug("Card worker starting up - Python {}".format(sys.version))
+def uses_fields(*fields):
+    """ A decorator declaring which Card attributes a function given to
+        map_multi reads. Only those attributes are sent to the workers, and
+        the function receives a CardView instead of the Card itself. """
+    def decorator(func):
+        func.card_fields = fields
+        return func
+    return decorator
+
+def _card_fields(func):
+    """ Returns the fields declared with uses_fields for func (or for the
+        function wrapped by a functools.partial), always including 'name',
+        or None if there are none. """
+    fields = getattr(func, 'card_fields', None)
+    if fields is None and hasattr(func, 'func'):
+        fields = getattr(func.func, 'card_fields', None)
+    if fields is None:
+        return None
+    return ('name',) + tuple(f for f in fields if f != 'name')
+
+class CardView(object):
+    """ Stands in for a Card in a worker process, with only the fields
+        its function declared. """
+    def __init__(self, fields, values):
+        self.__dict__.update(zip(fields, values))
+
+def _card_worker(work_queue, res_queue, wid, func=None, log_config=None):
+    """ Main loop of a CardPool worker. Messages on work_queue are either
+        ('state', pickled list of (put, value)), which calls put(value) for
+        each pair (see worker_state), ('func', pickled function), which sets
+        the function to apply, ('cards', seq, chunk), which applies it to
+        each item in chunk, or None, to exit. Chunk items are Cards, or
+        tuples of the function's declared fields. log_config, if given, is
+        from logs.worker_config(), for workers that weren't forked from the
+        process that set up logging.
+
+        For each chunk, (wid, seq, [(card name, result), ...], seconds taken)
+        is put on res_queue. If the state or the function can't be loaded,
+        (wid, None, None, 0) is put instead, and chunks are skipped from
+        then on. """
+    if log_config is not None:
+        logs.worker_setup(log_config)
+    logger.debug("Card worker starting up - Python %s", sys.version)
+    fields = func and _card_fields(func)
+    stale = False
     try:
         while True:
-            c = work_queue.get(timeout=0.2)
-            try:
-                res = func(c)
-                res_queue.put(res)
-            except queue.Full:
-                logger.error("Result queue full, can't add result for {}."
-                             .format(c.name))
-                res_queue.put(None)
-            except Exception as e:
-                logger.exception('Exception encountered processing {} for '
-                                 '{}: {}'.format(func.__name__, c.name, e))
-                res_queue.put(None)
-            finally:
-                work_queue.task_done(cname=c.name)
-    except queue.Empty:
-        return
+            msg = work_queue.get()
+            if msg is None:
+                return
+            if msg[0] == 'state':
+                try:
+                    for put, value in pickle.loads(msg[1]):
+                        put(value)
+                except Exception as e:
+                    logger.debug('Unable to load state: {}'.format(e))
+                    stale = True
+                    func = None
+                    res_queue.put((wid, None, None, 0))
+                continue
+            if msg[0] == 'func':
+                try:
+                    if stale:
+                        raise StalePoolError('Missing state.')
+                    func = pickle.loads(msg[1])
+                    fields = _card_fields(func)
+                except Exception as e:
+                    logger.debug('Unable to load function: {}'.format(e))
+                    func = None
+                    res_queue.put((wid, None, None, 0))
+                continue
+            _, seq, chunk = msg
+            start = time.perf_counter()
+            results = []
+            for c in chunk:
+                if fields:
+                    c = CardView(fields, c)
+                if func is None:
+                    results.append((c.name, None))
+                    continue
+                try:
+                    results.append((c.name, func(c)))
+                except Exception as e:
+                    logger.exception('Exception encountered processing {} '
+                                     'for {}: {}'.format(_func_name(func),
+                                                         c.name, e))
+                    results.append((c.name, None))
+            res_queue.put((wid, seq, results, time.perf_counter() - start))
     except Exception as e:
-        logger.fatal('Fatal exception processing {}: {}'
-                     .format(func.__name__, e))
+        logger.fatal('Fatal exception in card worker: {}'.format(e))
+
+class StalePoolError(Exception):
+    """ Raised when a CardPool's workers can't load the function or the
+        state they were sent, eg. a function defined in the interactive
+        interpreter, which the workers don't have. """
+
+# Module state the card workers need (see worker_state), by name:
+# (key, get, put).
+_worker_states = {}
+
+def worker_state(name, key, get, put):
+    """ Registers module state, such as a cache, that functions run by the
+        shared pool read. The workers don't share this process's memory, so
+        whenever the pool is used, key() is called here, and if its result
+        has changed since the state was last sent (or it never was), get()
+        is sent to every worker, which calls put() with it.
+
+        key() should be cheap and change whenever the state does. The value
+        from get() and the put function itself must be picklable (eg. put is
+        defined at the top level of a module). Registering the same name
+        again replaces it. """
+    _worker_states[name] = (key, get, put)
+
+def _set_log_level(level):
+    logging.getLogger().setLevel(level)
+
+worker_state('log level', lambda: logging.getLogger().level,
+             lambda: logging.getLogger().level, _set_log_level)
+
+# Modules that processes started by the forkserver (such as the shared
+# pool's workers) have imported before they start. See preload.
+_preload = ['__main__', __name__]
+multiprocessing.get_context('forkserver').set_forkserver_preload(_preload)
+
+def preload(*names):
+    """ Has the shared pool's workers start with the named modules (eg. the
+        generated grammar, which takes a while to import) already imported.
+        This only has an effect before the first pool starts. """
+    _preload.extend(n for n in names if n not in _preload)
+    multiprocessing.get_context('forkserver').set_forkserver_preload(_preload)
+
+def _server_context():
+    """ The multiprocessing context for pools that get their functions and
+        state by pickle. Their workers are forked from a server process,
+        which is started once, with the modules in _preload imported, and
+        has no threads. """
+    return multiprocessing.get_context('forkserver')
+
+class CardPool(object):
+    """ A set of worker processes that apply functions to cards.
+
+        Workers are started by a server process (see _server_context),
+        rather than forked from this one, which may have threads running
+        (eg. the log writer). They start with the modules in _preload
+        imported. A pool stays alive between calls to map(); functions are
+        pickled and sent to every worker at the start of each call, along
+        with any module state registered with worker_state that has changed
+        since the last call. If func is given, the workers are forked from
+        this process with it instead, so that it need not be pickleable, and
+        they start with all of this process's state.
+
+        Cards are sent in chunks, sized so that each chunk takes about
+        CHUNK_SECONDS to process, and results come back a chunk at a time.
+        If the function declares its fields with uses_fields, only those
+        fields are sent, so the amount of data sent per card doesn't grow
+        with whatever else has been attached to the cards. """
+
+    CHUNK_SECONDS = 0.05
+    MAX_CHUNK = 256
+
+    def __init__(self, processes, func=None):
+        if func is None:
+            ctx = _server_context()
+            log_config = logs.worker_config()
+            # The state the workers have, by name: its key when it was sent.
+            self._state_keys = {}
+        else:
+            ctx = multiprocessing.get_context('fork')
+            log_config = None
+            self._state_keys = {name: key()
+                                for name, (key, _, _) in _worker_states.items()}
+        self.processes = processes
+        self._func = func
+        self.busy = False
+        self.log_queue = logs.worker_config()[0]
+        self._results = ctx.Queue()
+        self._tasks = [ctx.Queue() for i in range(processes)]
+        self._workers = [ctx.Process(target=_card_worker,
+                                     args=(tq, self._results, i, func,
+                                           log_config),
+                                     daemon=True)
+                         for i, tq in enumerate(self._tasks)]
+        for p in self._workers:
+            p.start()
+
+    def _send_state(self):
+        """ Sends the workers any registered state that has changed since
+            it was last sent. """
+        updates = []
+        for name, (key, get, put) in _worker_states.items():
+            k = key()
+            if name not in self._state_keys or self._state_keys[name] != k:
+                updates.append((put, get()))
+                self._state_keys[name] = k
+        if updates:
+            sbytes = pickle.dumps(updates, pickle.HIGHEST_PROTOCOL)
+            for tq in self._tasks:
+                tq.put(('state', sbytes))
+
+    def _get_result(self):
+        while True:
+            try:
+                return self._results.get(timeout=1)
+            except queue.Empty:
+                if not all(p.is_alive() for p in self._workers):
+                    raise RuntimeError('A card worker exited unexpectedly.')
+
+    def map(self, func, cards, ordered=False):
+        """ Applies func to each card in cards, yielding results as they
+            come in, each as a pair (card name, result). If ordered is True,
+            results are yielded in the same order as cards instead.
+            If func is None, use the function the pool was created with.
+            Raises StalePoolError if the workers can't load func or the
+            state sent with it.
+
+            Cards are only taken from cards as workers need them, and only
+            a few chunks are ever outstanding or held back for ordering,
+            so cards can be any iterable (even an endless one) and nothing
+            more is done while the caller isn't taking results. """
+        if self.busy:
+            raise RuntimeError('CardPool.map is already running.')
+        self.busy = True
+        self._send_state()
+        if func is not None:
+            fbytes = pickle.dumps(func, pickle.HIGHEST_PROTOCOL)
+            for tq in self._tasks:
+                tq.put(('func', fbytes))
+        fields = _card_fields(func or self._func)
+        it = iter(cards)
+        chunksize = 1
+        sent = 0
+        pending = 0
+        # Results that came in ahead of an earlier chunk, when ordered.
+        held = {}
+        nextseq = 0
+        # Each worker gets at most two chunks at a time, so that work goes
+        # to whichever workers are free.
+        idle = collections.deque(list(range(self.processes)) * 2)
+        exhausted = False
+        try:
+            while True:
+                while (idle and not exhausted
+                       and pending + len(held) < 2 * self.processes):
+                    chunk = list(itertools.islice(it, chunksize))
+                    if not chunk:
+                        exhausted = True
+                        break
+                    if fields:
+                        chunk = [tuple(getattr(c, f) for f in fields)
+                                 for c in chunk]
+                    self._tasks[idle.popleft()].put(('cards', sent, chunk))
+                    sent += 1
+                    pending += 1
+                if not pending:
+                    break
+                wid, seq, results, elapsed = self._get_result()
+                if results is None:
+                    raise StalePoolError('Workers are unable to load {}.'
+                                         .format(_func_name(func)))
+                pending -= 1
+                idle.append(wid)
+                if results and elapsed > 0:
+                    per_card = elapsed / len(results)
+                    chunksize = max(1, min(self.MAX_CHUNK,
+                                           int(self.CHUNK_SECONDS / per_card)))
+                elif results:
+                    chunksize = self.MAX_CHUNK
+                if not ordered:
+                    yield from results
+                    continue
+                held[seq] = results
+                while nextseq in held:
+                    yield from held.pop(nextseq)
+                    nextseq += 1
+        finally:
+            # If we stopped early, collect what's still outstanding
+            # so it doesn't turn up in the next call.
+            try:
+                while pending:
+                    self._get_result()
+                    pending -= 1
+            except RuntimeError:
+                pass
+            self.busy = False
+
+    def close(self):
+        """ Stops the workers. """
+        for tq in self._tasks:
+            tq.put(None)
+        for p in self._workers:
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+        self._workers = []
+
+_pool = None
+
+def get_pool(processes=None):
+    """ Returns the shared CardPool, starting it if necessary. Calling this
+        ahead of time lets the workers start up before they're needed.
+
+        processes: The number of processes. If None, defaults to the
+            number of CPUs. """
+    global _pool
+    if not processes:
+        processes = multiprocessing.cpu_count()
+    # A pool started before logs.setup (or a previous one) would log
+    # nowhere.
+    if _pool is not None and (_pool.processes != processes
+                              or _pool.log_queue
+                                 is not logs.worker_config()[0]):
+        _pool.close()
+        _pool = None
+    if _pool is None:
+        _pool = CardPool(processes)
+    return _pool
+
+def shutdown_pool():
+    """ Stops the shared CardPool, if it is running. """
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool = None
+
+atexit.register(shutdown_pool)
 
 def map_multi(func, cards, processes=None):
     """ Applies a given function to each card in cards, utilizing
@@ -348,58 +781,121 @@ def map_multi(func, cards, processes=None):
         are stripped out. If correlated results are desired, the function
         should return the name of the card alongside the result.
 
+        The work is done by the shared CardPool (see get_pool), which is
+        reused between calls. Its workers only have the module state
+        registered with worker_state. If func can't be pickled or loaded by
+        the workers (eg. it is a closure), a temporary pool forked from this
+        process is used for this call instead.
+
         func: A function that takes in a single Card object as an argument.
             Any modifications this function makes to Card data will be lost
             when it exits, hence it should return said data and the callee
             should modify the Card as specified. The only caveat to this is
-            that the data it returns must be pickleable.
+            that the data it returns must be pickleable. Functions that only
+            need a few of the Card's attributes should declare them with
+            uses_fields, so that less data is sent to the workers.
         cards: An iterable of Card objects that supports __len__.
         processes: The number of processes. If None, defaults to the 
             number of CPUs. """
-    if not processes:
-        processes = multiprocessing.cpu_count()
-    q = CardProgressQueue(cards)
-    rq = multiprocessing.Queue()
-    pr = [multiprocessing.Process(target=_card_worker, args=(q, rq, func))
-          for i in range(processes)]
-    for p in pr:
-        p.start()
-    q.join()
+    pbar, cw = _card_progress_bar(len(cards))
     result = []
-    for i in range(len(cards)):
-        res = rq.get()
+    for i, (cname, res) in enumerate(_pool_map(func, cards, processes)):
+        cw.current_card = cname
+        pbar.update(i + 1)
         if res is not None:
             result.append(res)
-    for p in pr:
-        p.join()
+    pbar.finish()
     return result
 
+def imap_multi(func, cards, processes=None, ordered=False):
+    """ Like map_multi, but a generator that yields results as soon as
+        they're ready, instead of returning them all at the end.
+
+        cards can be any iterable, including a generator; cards are only
+        taken from it as workers become free, and only a few chunks of work
+        are in flight at a time. If ordered is True, results are yielded in
+        the same order as the cards they came from. No progress bar is
+        displayed. """
+    for cname, res in _pool_map(func, cards, processes, ordered):
+        if res is not None:
+            yield res
+
+def _temporary_map(func, cards, processes=None, ordered=False, fork=False):
+    """ Runs func over cards in a new pool, which is closed afterward.
+        If fork is True, the pool is forked from this process with func. """
+    processes = processes or multiprocessing.cpu_count()
+    pool = CardPool(processes, func if fork else None)
+    try:
+        yield from pool.map(None if fork else func, cards, ordered)
+    finally:
+        pool.close()
+
+def _pool_map(func, cards, processes=None, ordered=False):
+    """ Runs func over cards in the appropriate pool, yielding pairs
+        (card name, result). The shared pool is used unless it is already
+        in use (eg. by an imap_multi that hasn't finished), in which case
+        a temporary one like it is used, or func can't be pickled or loaded
+        by its workers, in which case a temporary pool is forked with func.
+        """
+    try:
+        pickle.dumps(func, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, AttributeError, TypeError):
+        logger.debug("Forking a pool for {}.".format(_func_name(func)))
+        yield from _temporary_map(func, cards, processes, ordered, fork=True)
+        return
+    if _pool is not None and _pool.busy:
+        logger.debug("Using a temporary pool for {}."
+                     .format(_func_name(func)))
+        yield from _temporary_map(func, cards, processes, ordered)
+        return
+    try:
+        yield from get_pool(processes).map(func, cards, ordered)
+        return
+    except StalePoolError:
+        pass
+    # No results are yielded before a StalePoolError, and the workers may
+    # have results left over, so replace them, and fork a pool with func.
+    logger.debug("Forking a pool for {}, which the card pool can't load."
+                 .format(_func_name(func)))
+    shutdown_pool()
+    yield from _temporary_map(func, cards, processes, ordered, fork=True)
+
 ## cardname processing ##
 
-def potential_names(words, cardnames):
-    """ cardnames is a list of potential names, either SELF or PARENT,
-        that should not be replaced with NAME_ tokens. """
+def _name_run(words):
+    """ Returns the text at the start of words that may be made of names,
+        and whether it may be a list of names joined by "and" or "or".
+        The latter is None if it can only be a single name. """
     name = words[0]
     name2 = ''
     namelist = False
     if name[-1] in ':."':
-        yield (name[:-1],)
-    else:
-        for i, w in enumerate(words[1:]):
-            if w[0].isupper():
-                name += name2 + ' ' + w
-                name2 = ''
-                if name[-1] in ':."':
-                    break
-            elif w in ['of', 'from', 'to', 'in', 'on', 'the', 'a']:
-                name2 += ' ' + w
-            elif w in ['and', 'or']:
-                namelist = True
-                name2 += ' ' + w
-            else:
+        return name[:-1], None
+    for i, w in enumerate(words[1:]):
+        if w[0].isupper():
+            name += name2 + ' ' + w
+            name2 = ''
+            if name[-1] in ':."':
                 break
-        name = name.rstrip(',.:"')
-        yield (name, )
+        elif w in ['of', 'from', 'to', 'in', 'on', 'the', 'a']:
+            name2 += ' ' + w
+        elif w in ['and', 'or']:
+            namelist = True
+            name2 += ' ' + w
+        else:
+            break
+    return name.rstrip(',.:"'), namelist
+
+def potential_names(words, cardnames):
+    """ Yields the ways the names at the start of words might be split, in
+        order of preference. split_names() picks from the same list
+        without building each entry.
+
+        cardnames is a list of potential names, either SELF or PARENT,
+        that should not be replaced with NAME_ tokens. """
+    name, namelist = _name_run(words)
+    yield (name, )
+    if namelist is not None:
         if namelist:
             for sep in [' and ', ' or ']:
                 names = name.split(sep)
@@ -443,13 +939,122 @@ def potential_names(words, cardnames):
                 del names[-1]
                 yield (', '.join(names), )
 
-def format_by_name(names, words):
+def _name_splits(ws, namelist, cardnames):
+    """ Yields the same splits as potential_names, in the same order, for
+        the words ws of the run given by _name_run. Each name in a split is
+        a span (start, end, strip) of ws, where strip means the comma ending
+        the last word is left off. """
+    m = len(ws)
+    yield ((0, m, False), )
+    if namelist is None:
+        return
+    if not namelist:
+        for b in range(m - 1, 0, -1):
+            if ws[b - 1].endswith(','):
+                yield ((0, b, True), )
+        return
+    for sep in ['and', 'or']:
+        # Where str.split(' and ') would split: each match uses up the
+        # space after it, so the word after can't be another match.
+        cuts = []
+        k = 1
+        while k < m - 1:
+            if ws[k] == sep:
+                cuts.append(k)
+                k += 1
+            k += 1
+        for c in reversed(cuts):
+            right = (c + 1, m, False)
+            right_text = ' '.join(ws[c + 1:])
+            starts = [0] + [q + 1 for q in range(c - 1)
+                            if ws[q].endswith(',')]
+            ends = starts[1:] + [c]
+            parts = tuple((a, e, ws[e - 1].endswith(','))
+                          for a, e in zip(starts, ends))
+            k = len(parts)
+            if k == 1 and parts[0][2] and right_text in cardnames:
+                yield parts
+            if k > 1:
+                yield parts + (right, )
+                if k > 2:
+                    for j in range(k - 2, 1, -1):
+                        yield ((0, starts[j], True), ) + parts[j:] + (right, )
+                    t = ((0, starts[-1], True), parts[-1])
+                    if right_text not in cardnames:
+                        t += (right, )
+                    yield t
+            else:
+                yield ((0, c, False), right)
+
+def _span_text(ws, span):
+    a, e, strip = span
+    last = ws[e - 1][:-1] if strip else ws[e - 1]
+    return ' '.join(ws[a:e - 1] + [last])
+
+# Built on demand by get_name_trie().
+_name_trie = None
+
+def get_name_trie():
+    """ Returns an index.NameTrie of every name in all_names, building it
+        if necessary. """
+    global _name_trie
+    if _name_trie is None:
+        _name_trie = index.NameTrie(all_names)
+    return _name_trie
+
+def split_names(words, cardnames, refs=None):
+    """ Returns the splits of the names at the start of words into known
+        names, in the order potential_names gives them, along with the split
+        to fall back on if there are none.
+
+        Whether each span of words is a name is looked up once, by walking
+        the name trie from where the span starts, so the work done is linear
+        in the number of words for each place a name can start.
+        See preprocess_names for refs. """
+    name, namelist = _name_run(words)
+    ws = name.split(' ')
+    trie = get_name_trie()
+    paths = {}
+    known = {}
+
+    def is_known(span):
+        k = known.get(span)
+        if k is None:
+            a, e, strip = span
+            path = paths.get(a)
+            if path is None:
+                path = paths[a] = trie.walk(ws, a)
+            last = ws[e - 1][:-1] if strip else ws[e - 1]
+            k = known[span] = trie.ends(path, e - 1 - a, last)
+            if refs is not None:
+                refs.setdefault(_span_text(ws, span), k)
+        return k
+
+    good = []
+    split = None
+    for split in _name_splits(ws, namelist, cardnames):
+        if all(is_known(span) for span in split):
+            good.append(tuple(_span_text(ws, span) for span in split))
+    fallback = split and tuple(_span_text(ws, span) for span in split)
+    return good, fallback
+
+def add_token_name(name):
+    """ Adds a name that isn't a card's name (ie. a token's) to the
+        all_names dicts. """
+    uname = construct_uname(name)
+    all_names[name] = uname
+    all_names_inv[uname] = name
+    if _name_trie is not None:
+        _name_trie.add(name)
+
+def format_by_name(names, words, tokens=None):
+    """ If tokens is a list, any token names found are appended to it. """
     for name in names:
         if name not in all_names:
             logger.info("Found token name: {}".format(name))
-            uname = construct_uname(name)
-            all_names[name] = uname
-            all_names_inv[uname] = name
+            add_token_name(name)
+            if tokens is not None:
+                tokens.append(name)
     if len(names) == 1:
         # number of words == number of spaces + 1
         ll = len([a for a in names[0] if a == ' ']) + 1
@@ -475,32 +1080,102 @@ def format_by_name(names, words):
 # For testing PARENT detection.
 _parentcards = set()
 
+# Built on demand by get_name_matcher().
+_name_matcher = None
+
+def get_name_matcher():
+    """ Returns an index.NameMatcher for every name in all_names and
+        all_shortnames, building it if necessary. """
+    global _name_matcher
+    if _name_matcher is None:
+        _name_matcher = index.NameMatcher(list(all_names)
+                                          + list(all_shortnames))
+    return _name_matcher
+
+# Names containing these characters mean something else as a regex.
+_regex_special = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+@functools.lru_cache(maxsize=None)
+def _name_regex(cardname):
+    return re.compile(r"\b{}(?!\w)".format(cardname), flags=re.UNICODE)
+
+def _is_word(ch):
+    """ Whether ch matches \w (with re.UNICODE). """
+    return ch.isalnum() or ch == '_'
+
+def _subn_name(cardname, repl, line, found):
+    """ Equivalent to re.subn(r"\b{cardname}(?!\w)", repl, line),
+        given the result of NameMatcher.find(line).
+
+        Names that the matcher doesn't know about (eg. tokens found since it
+        was built) or that contain regex metacharacters are handed to re,
+        as is everything if found is None. """
+    if (found is None or cardname not in _name_matcher
+        or _regex_special.search(cardname)):
+        return _name_regex(cardname).subn(repl, line)
+    parts = []
+    pos = 0
+    count = 0
+    first = _is_word(cardname[0])
+    for start in found.get(cardname, ()):
+        end = start + len(cardname)
+        if start < pos:
+            continue
+        if (start > 0 and _is_word(line[start - 1])) == first:
+            continue
+        if end < len(line) and _is_word(line[end]):
+            continue
+        parts.append(line[pos:start])
+        parts.append(repl)
+        pos = end
+        count += 1
+    if not count:
+        return line, 0
+    parts.append(line[pos:])
+    return ''.join(parts), count
+
 def preprocess_cardname(line, selfnames=(), parentnames=()):
-    """ Checks only for matches against a card's name. """
+    """ Checks only for matches against a card's name.
+
+        The name matcher is used if it has been built (as preprocess_all
+        does); otherwise each name is searched for with a regex, which is
+        quicker for a few cards. """
     change = False
+    matcher = _name_matcher
+    found = None
     for cardname in selfnames:
         if cardname in line:
-            line, count = re.subn(r"\b{}(?!\w)".format(cardname),
-                                  "SELF", line, flags=re.UNICODE)
+            if found is None and matcher is not None:
+                found = matcher.find(line)
+            line, count = _subn_name(cardname, "SELF", line, found)
             if count > 0:
                 change = True
+                found = None
                 if parentnames:
                     logger.info("Detected SELF in an ability granted by {}."
                                 .format(parentnames[0]))
     for cardname in parentnames:
         if cardname in line:
-            line, count = re.subn(r"\b{}(?!\w)".format(cardname),
-                                  "PARENT", line, flags=re.UNICODE)
+            if found is None and matcher is not None:
+                found = matcher.find(line)
+            line, count = _subn_name(cardname, "PARENT", line, found)
             if count > 0:
+                found = None
                 change = True
                 logger.info("Detected PARENT in an ability granted by {}."
                             .format(cardname))
                 _parentcards.add(cardname)
     return line, change
 
-def preprocess_names(line, selfnames=(), parentnames=()):
+def preprocess_names(line, selfnames=(), parentnames=(), refs=None,
+                     tokens=None):
     """ This requires that each card was instantiated as a Card and their names
-        added to the all_names dicts as appropriate. """
+        added to the all_names dicts as appropriate.
+
+        If refs is a dict, each name looked up in all_names is recorded there
+        with whether it was found, and token names found are appended to
+        tokens, so that the result can be reused as long as the answers to
+        those lookups stay the same. """
     change = False
     match = name_ref.search(line)
     while match:
@@ -508,21 +1183,17 @@ def preprocess_names(line, selfnames=(), parentnames=()):
         i, j = match.regs[0]
         words = line[j:].split()
         if not words[0][0].islower():
-            good = []
-            bad = []
-            for names in potential_names(words, selfnames + parentnames):
-                if all((name in all_names for name in names)):
-                    good += [names]
-                else:
-                    bad += [names]
+            good, fallback = split_names(words, selfnames + parentnames,
+                                         refs)
             if len(good) > 1:
                 logger.warning("Multiple name splits possible: {}."
                                .format("; ".join(map(str, good))))
-            res = good and good[0] or bad and bad[-1] or None
+            res = good and good[0] or fallback
             if res:
-                logger.debug("Selected name(s) at position {} "
-                              "as: {}".format(j, "; ".join(res)))
-                line = (line[:j] + format_by_name(res, words))
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Selected name(s) at position %s as: %s",
+                                 j, "; ".join(res))
+                line = (line[:j] + format_by_name(res, words, tokens))
                 if len(res) == 1 and '"' not in line[:i] and not parentnames:
                     # Check for abilities granted
                     t = abil.search(line[j:])
@@ -531,7 +1202,7 @@ def preprocess_names(line, selfnames=(), parentnames=()):
                         # Created tokens don't get shortnames
                         line = (line[:m + j]
                                 + preprocess_names(t.group(), (res[0],),
-                                                   selfnames)
+                                                   selfnames, refs, tokens)
                                 + line[n + j:])
                         j += n
                 change = True
@@ -556,7 +1227,7 @@ def preprocess_names(line, selfnames=(), parentnames=()):
     line, cardname_change = preprocess_cardname(line, selfnames, parentnames)
     if change or cardname_change:
         sname = selfnames and selfnames[0] or "?.token"
-        logger.debug("Now: {} | {}".format(sname, line))
+        logger.debug("Now: %s | %s", sname, line)
     return line
 
 # Basically, LPAREN then anything until RPAREN, but there may
@@ -604,18 +1275,300 @@ def preprocess_non(text):
 
 ## Main entry point for the preprocessing step ##
 
-def preprocess_all(cards):
+def _preprocess_hash(c):
+    """ A hash of everything about a card that preprocessing depends on,
+        aside from the names in all_names. """
+    return hashlib.sha1('\0'.join([c.name, c.shortname or '', c.rules])
+                        .encode('utf-8')).digest()
+
+def preprocess_card(c, refs=None, tokens=None):
+    """ Returns the preprocessed rules text for a single card.
+        See preprocess_names for refs and tokens. """
+    names = (c.name,)
+    if c.shortname:
+        names += (c.shortname,)
+    lines = [preprocess_capitals(
+                preprocess_reminder(preprocess_names(line, names,
+                                                     refs=refs,
+                                                     tokens=tokens)))
+             for line in c.rules.split("\n")]
+    return preprocess_non("\n".join(lines))
+
+class _Preprocessor(object):
+    """ Preprocesses cards in CardPool workers. It carries the name registry
+        of the process that created it, which replaces the worker's own when
+        it is unpickled there. Each card is processed against that registry:
+        token names it adds are removed again afterward, and returned along
+        with the rules text and the names looked up. """
+    card_fields = ('name', 'shortname', 'rules')
+
+    def __init__(self):
+        self.names = dict(all_names)
+        self.names_inv = dict(all_names_inv)
+
+    def __setstate__(self, state):
+        global _name_trie, _name_matcher
+        self.__dict__.update(state)
+        all_names.clear()
+        all_names.update(self.names)
+        all_names_inv.clear()
+        all_names_inv.update(self.names_inv)
+        _name_trie = None
+        _name_matcher = None
+
+    def __call__(self, c):
+        get_name_matcher()
+        refs = {}
+        tokens = []
+        rules = preprocess_card(c, refs, tokens)
+        for name in tokens:
+            del all_names_inv[all_names.pop(name)]
+            if _name_trie is not None:
+                _name_trie.discard(name)
+        return rules, refs, tokens
+
+def _refs_hold(refs):
+    """ Whether every name in refs is still known (or unknown) as recorded. """
+    return all((name in all_names) == known for name, known in refs.items())
+
+def preprocess_all(cards, records=None, processes=1, total=None):
     """ Scans the rules texts of every card to replace any card names that
-        appear with appropriate symbols, and eliminates reminder text. """
+        appear with appropriate symbols, and eliminates reminder text.
+
+        records is a dict returned by a previous call, mapping card names to
+        what was done to them. A card is only processed again if its text
+        changed or if a name its text was checked against has since been
+        added or removed; otherwise the saved result is used, which is
+        identical to what processing the card again would produce.
+
+        If processes is not 1, cards are processed by the card pool with
+        that many workers (None for one per CPU), against the names known
+        beforehand. Their results are merged in order, adding the token names
+        they found. Any card whose result depended on a token name added by
+        an earlier card is processed again here, so the results are the same
+        as processing every card here in turn.
+
+        cards may be a generator, such as Card.load_all() while the cards
+        are being loaded, as long as every card's name is already known
+        (see register_names), in which case total is the number of cards it
+        will yield. Cards are then handed to the workers as they come, so
+        that loading the rest overlaps with preprocessing.
+
+        Returns the records for this run. """
+    global _text_index, _name_matcher, _name_trie
+    _text_index = None
+    _name_matcher = None
+    _name_trie = None
+    get_name_matcher()
+    if records is None:
+        records = {}
+    pairs = ((c, _preprocess_hash(c)) for c in cards)
+    if total is None:
+        pairs = list(pairs)
+        total = len(pairs)
+    new_records = {}
+    reused = 0
+    redone = 0
+    results = None
+    if processes != 1:
+        # The workers take cards from their own copy of the stream.
+        pairs, theirs = itertools.tee(pairs)
+        todo = (c for c, h in theirs
+                if c.name not in records or records[c.name][0] != h)
+        results = _pool_map(_Preprocessor(), todo, processes, ordered=True)
     print("Processing cards for card names...")
-    for c in CardProgressBar(cards):
-        names = (c.name,)
-        if c.shortname:
-            names += (c.shortname,)
-        lines = [preprocess_capitals(
-                    preprocess_reminder(preprocess_names(line, names)))
-                 for line in c.rules.split("\n")]
-        c.rules = preprocess_non("\n".join(lines))
+    pbar, cw = _card_progress_bar(total)
+    try:
+        for i, (c, h) in enumerate(pairs):
+            cw.current_card = c.name
+            pbar.update(i)
+            r = records.get(c.name)
+            res = None
+            if r and r[0] == h:
+                if _refs_hold(r[2]):
+                    res = r[1:]
+                    reused += 1
+            elif results is not None:
+                _, res = next(results)
+                if res is not None and _refs_hold(res[1]):
+                    rules, refs, tokens = res
+                    res = (rules, refs,
+                           [name for name in tokens if name not in all_names])
+                else:
+                    res = None
+                    redone += 1
+            if res:
+                rules, refs, tokens = res
+                for name in tokens:
+                    add_token_name(name)
+            else:
+                refs = {}
+                tokens = []
+                rules = preprocess_card(c, refs, tokens)
+            c.rules = rules
+            new_records[c.name] = (h, rules, refs, tokens)
+        pbar.finish()
+    finally:
+        if results is not None:
+            results.close()
+    if records:
+        logger.info("Reused preprocessing results for {} of {} cards."
+                    .format(reused, len(new_records)))
+    if results is not None:
+        logger.info("Processed {} of {} cards again after merging."
+                    .format(redone, len(new_records)))
+    return new_records
+
+## Building cards on demand ##
+
+class CardStore(object):
+    """ Builds Cards from the data files as they're asked for, using the
+        offset index from data.load_offsets to find each card's entry in
+        the memory-mapped files. """
+
+    def __init__(self, files=None):
+        self._where = {}
+        for filename, offsets in data.load_offsets(files).items():
+            for name, (start, end) in offsets.items():
+                self._where.setdefault(name, (filename, start, end))
+        self._maps = {}
+
+    def __contains__(self, name):
+        return name in self._where
+
+    def __len__(self):
+        return len(self._where)
+
+    def names(self):
+        """ Returns the names of all the cards in the data files. """
+        return self._where.keys()
+
+    def raw(self, name):
+        """ Returns the entry for the named card, as in data.load(). """
+        filename, start, end = self._where[name]
+        m = self._maps.get(filename)
+        if m is None:
+            with open(filename, 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[filename] = m
+        return m[start:end].decode('utf-8').strip()
+
+    def get(self, name):
+        """ Returns the named Card, building it if it hasn't been already,
+            or None if there's no such card. """
+        c = _all_cards.get(name)
+        if c is None and name in self._where:
+            c = Card.from_string(self.raw(name))
+        return c
+
+    def close(self):
+        for m in self._maps.values():
+            m.close()
+        self._maps = {}
+
+def open_store(files=None):
+    """ Makes get_card build any card that hasn't been loaded from the data
+        files, and adds the name of every card in them to all_names, so that
+        a card's rules text can be preprocessed without loading the rest.
+        Shortnames are only known for cards that have been built.
+        Returns the CardStore. """
+    global _card_store
+    if _card_store is not None:
+        _card_store.close()
+    _card_store = CardStore(files)
+    register_names(_card_store.names())
+    return _card_store
+
+def register_names(names):
+    """ Adds names to all_names before their cards are built, so that the
+        rules text of any card can be preprocessed against them. """
+    for name in names:
+        if name not in all_names:
+            uname = construct_uname(name)
+            all_names[name] = uname
+            all_names_inv[uname] = name
+
+## Saving and restoring the card registry ##
+
+def snapshot():
+    """ Returns the current state of the card registry as a picklable
+        object, which can later be passed to restore(). """
+    return {'cards': _all_cards,
+            'names': all_names,
+            'names_inv': all_names_inv,
+            'shortnames': all_shortnames,
+            'sets': cards_by_set,
+            'card_list': _card_list,
+            'card_indexes': card_indexes(),
+            'text_index': text_index()}
+
+def restore(state):
+    """ Replaces the card registry with the state given by snapshot().
+        The module-level dicts are updated in place, so existing references
+        to them remain valid. """
+    global _text_index, _name_matcher, _name_trie, _card_indexes
+    _text_index = state.get('text_index')
+    _card_indexes = state.get('card_indexes')
+    _card_list[:] = state['card_list']
+    _card_ids.clear()
+    _card_ids.update((c.name, i) for i, c in enumerate(_card_list))
+    _name_matcher = None
+    _name_trie = None
+    for d, k in [(_all_cards, 'cards'), (all_names, 'names'),
+                 (all_names_inv, 'names_inv'), (all_shortnames, 'shortnames'),
+                 (cards_by_set, 'sets')]:
+        d.clear()
+        d.update(state[k])
+    logger.info("Restored {} cards from snapshot.".format(len(_all_cards)))
+
+def card_indexes():
+    """ Returns the dict of index.BitsetIndex by kind that card_bits uses,
+        building it if necessary. Cards created afterward are added to it. """
+    global _card_indexes
+    if _card_indexes is None:
+        indexes = {kind: index.BitsetIndex() for kind in _index_kinds}
+        for i, c in enumerate(_card_list):
+            for kind, values in _index_values(c):
+                indexes[kind].add(i, values)
+        for idx in indexes.values():
+            idx.compact()
+        _card_indexes = indexes
+    return _card_indexes
+
+def card_bits(kind, value):
+    """ Returns the ids of the cards with the given value of one kind of
+        attribute, as the set bits of an int. Ints from different calls can
+        be combined with &, | and &~, and given to cards_from_bits.
+
+        kind is one of:
+            'set': a set code, eg. 'M10'
+            'set_rarity': a set code and rarity, as in the S/R field,
+                eg. 'M10-M'
+            'rarity': a rarity in any set, eg. 'M'
+            'supertype', 'type', 'subtype': a word from the typeline,
+                eg. 'legendary', 'creature', 'goblin' (see Card.get_types)
+            'color': a color from cost or color indicator, eg. 'W'
+            'multitype': 'split', 'flip' or 'transform' """
+    if kind not in _index_kinds:
+        raise ValueError('Unknown card index: {}'.format(kind))
+    return card_indexes()[kind].get(value)
+
+def all_card_bits():
+    """ Returns the ids of every card, as the set bits of an int. """
+    return (1 << len(_card_list)) - 1
+
+def cards_from_bits(bits):
+    """ Returns the list of Cards whose ids are the set bits of bits. """
+    return [_card_list[i] for i in index.bit_ids(bits)]
+
+def find_cards(**criteria):
+    """ Returns the list of Cards matching every one of the given criteria,
+        which are card_bits kinds and values,
+        eg. find_cards(set='M10', type='creature'). """
+    bits = all_card_bits()
+    for kind, value in criteria.items():
+        bits &= card_bits(kind, value)
+    return cards_from_bits(bits)
 
 def get_cards():
     """ Returns a set of all the Cards instantiated with the Card class. """
@@ -623,14 +1576,16 @@ def get_cards():
 
 def get_card_set(setname):
     """ Returns a set of all the Cards in the given set. """
-    if setname not in cards_by_set:
-        return set()
-    return {_all_cards.get(cardname) for cardname in cards_by_set[setname]}
+    return set(cards_from_bits(card_bits('set', setname)))
 
 def get_card(cardname):
     """ Returns a specific card by name, or None if no such card exists. """
     cardname = str(cardname)
-    return _all_cards.get(all_shortnames.get(cardname, cardname))
+    cardname = all_shortnames.get(cardname, cardname)
+    c = _all_cards.get(cardname)
+    if c is None and _card_store is not None:
+        c = _card_store.get(cardname)
+    return c
 
 def get_name_from_uname(uname):
     """ Returns the English card for an object, given its unique name. """
@@ -638,6 +1593,31 @@ def get_name_from_uname(uname):
 
 ## Utility functions to search card text, get simple text stats ##
 
+def text_index():
+    """ Returns the index.TrigramIndex of the rules text of all cards,
+        building it if necessary. Cards created afterward, and new rules
+        text set on a card, are added to it, and it is rebuilt after
+        preprocessing. """
+    global _text_index
+    if _text_index is None:
+        _text_index = index.TrigramIndex()
+        for c in _all_cards.values():
+            _text_index.add_card(c.name, c.rules)
+    return _text_index
+
+def _search_cards(r, cards):
+    """ Returns those cards (or all cards, if not given) whose rules text
+        the text index says might contain a match for the compiled regex r.
+        """
+    names = text_index().candidate_cards(r)
+    if not cards:
+        if names is None:
+            return get_cards()
+        return [_all_cards[name] for name in names]
+    if names is None:
+        return cards
+    return [c for c in cards if c.name in names]
+
 def search_text(text, cards=None, reflags=re.I|re.U):
     """ Returns a list of (card name, line of text), containing
         every line in the text of a card that contains a match for the
@@ -645,11 +1625,12 @@ def search_text(text, cards=None, reflags=re.I|re.U):
 
         A subset of cards can be specified if one doesn't want to search
         the entire set. """
-    if not cards:
-        cards = get_cards()
     r = re.compile(text, reflags)
-    return [(c.name, line) for c in cards for line in c.rules.split('\n')
-            if r.search(line)]
+    if not cards:
+        return text_index().search(r)
+    # In the order of the given cards.
+    return [(c.name, line) for c in _search_cards(r, cards)
+            for line in c.rules.split('\n') if r.search(line)]
 
 def preceding_words(text, cards=None, reflags=re.I|re.U):
     """ Returns a set of words which appear anywhere in a card's rules text
@@ -657,11 +1638,9 @@ def preceding_words(text, cards=None, reflags=re.I|re.U):
 
         A subset of cards can be specified if one doesn't want to search
         the entire set. """
-    if not cards:
-        cards = get_cards()
     r = re.compile(r"([\w'-—]+)(?: | ?—){}".format(text), reflags)
     a = set()
-    for c in cards:
+    for c in _search_cards(r, cards):
         a.update(r.findall(c.rules))
     return a
 
@@ -671,11 +1650,9 @@ def following_words(text, cards=None, reflags=re.I|re.U):
 
         A subset of cards can be specified if one doesn't want to search
         the entire set. """
-    if not cards:
-        cards = get_cards()
     r = re.compile(r"{}(?: |— ?)([\w'-—]+)".format(text), reflags)
     a = set()
-    for c in cards:
+    for c in _search_cards(r, cards):
         a.update(r.findall(c.rules))
     return a
 
@@ -686,11 +1663,9 @@ def matching_text(text, cards=None, reflags=re.I|re.U, group=0):
 
         A subset of cards can be specified if one doesn't want to search
         the entire set. """
-    if not cards:
-        cards = get_cards()
     r = re.compile(text, reflags)
     a = set()
-    for c in cards:
+    for c in _search_cards(r, cards):
         for m in r.finditer(c.rules):
             a.add(m.group(group))
     return a
@@ -18,10 +18,22 @@
 
 """data -- Demystify library for loading and updating card data."""
 
+import bz2
+import collections
+import concurrent.futures
+import contextlib
 import difflib
+import gzip
+import hashlib
+import itertools
+import json
 import logging
+import lzma
+import multiprocessing
 import os
+import pickle
 import re
+import tempfile
 from functools import partial
 
 llog = logging.getLogger('Loader')
@@ -37,6 +49,62 @@ dlog.setLevel(logging.INFO)
 DATADIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
 TEXTFILES = [os.path.join(DATADIR, "text", c)
              for c in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0']
+CACHEDIR = os.path.join(DATADIR, "cache")
+
+## Cache ##
+
+def content_hash(*filenames):
+    """ Returns a hex digest of the contents of the given files, in order.
+        Suitable as a cache key for anything derived from those files. """
+    h = hashlib.sha1()
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def load_cache(kind, key):
+    """ Returns the object stored in the cache under kind, or None if
+        there is no such object or it was stored under a different key. """
+    path = os.path.join(CACHEDIR, kind)
+    try:
+        with open(path, 'rb') as f:
+            if pickle.load(f) != key:
+                llog.info("Cache {} is stale.".format(kind))
+                return None
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        llog.warning("Unable to read cache {}: {}".format(kind, e))
+        return None
+
+@contextlib.contextmanager
+def replacing(path, mode='w'):
+    """ Opens a temporary file next to path for writing, and replaces path
+        with it once the with block finishes, so that concurrent readers
+        see either the old file or the new one, never a partial one.
+        If the block raises, path is left alone. """
+    dirname, basename = os.path.split(path)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix=basename + '.')
+    try:
+        if os.path.exists(path):
+            os.chmod(tmp, os.stat(path).st_mode)
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+def save_cache(kind, key, obj):
+    """ Stores obj in the cache under kind, replacing whatever was there.
+        The file is written atomically so that concurrent readers never
+        see a partial cache. """
+    if not os.path.exists(CACHEDIR):
+        os.makedirs(CACHEDIR)
+    with replacing(os.path.join(CACHEDIR, kind), 'wb') as f:
+        pickle.dump(key, f, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
 
 ## Loader ##
 
@@ -77,6 +145,132 @@ def load(files=None):
     llog.info("Loaded {} cards total.".format(ncards))
     return raw_cards
 
+# One match per non-blank line: either a field of the card, or a line of
+# its rules text.
+_card_line = re.compile(r'^(?:(Name|Cost|Color|Type|P/T|S/R|M-type|M-card):'
+                        r'(.*)|([^\S\n]*\S.*))$', re.M)
+_field_args = {'Cost': 'cost', 'Color': 'color', 'P/T': 'pt',
+               'S/R': 'set_rarity', 'M-type': 'multitype',
+               'M-card': 'multicard'}
+
+def _scan(filename):
+    """ Returns the cards in a data file as a list of
+        (name, typeline, keyword arguments for card.Card). """
+    with open(filename) as f:
+        text = f.read()
+    cards = []
+    kwargs = None
+    # Any lines before the first card are collected here and dropped.
+    rules = []
+    for field, value, line in _card_line.findall(text):
+        if line:
+            rules.append(line.strip())
+        elif field == 'Name':
+            if kwargs is not None:
+                kwargs['rules'] = '\n'.join(rules)
+                cards.append((name, typeline, kwargs))
+            name = value.strip()
+            typeline = ''
+            kwargs = {}
+            rules = []
+        elif kwargs is None:
+            continue
+        elif field == 'Type':
+            typeline = value.strip()
+        else:
+            kwargs[_field_args[field]] = value.strip()
+    if kwargs is not None:
+        kwargs['rules'] = '\n'.join(rules)
+        cards.append((name, typeline, kwargs))
+    return cards
+
+def scan(files=None, threads=None):
+    """ Yields (name, typeline, keyword arguments for card.Card) for each
+        card in the data files, in order. The fields are the same as
+        card.Card.from_string finds in each of the cards load() returns.
+
+        The files are read and scanned by a pool of threads (by default, one
+        per CPU), so that later files are ready by the time the cards in
+        earlier ones have been used. """
+    if not files:
+        files = TEXTFILES
+    if not threads:
+        threads = min(len(files), os.cpu_count() or 1)
+    n = 0
+    with concurrent.futures.ThreadPoolExecutor(threads) as ex:
+        for filename, cards in zip(files, ex.map(_scan, files)):
+            llog.debug("Scanned %d cards from %s.", len(cards), filename)
+            n += len(cards)
+            yield from cards
+    llog.info("Scanned {} cards total.".format(n))
+
+## Per-file indexes ##
+
+_name_line = re.compile(rb'^Name:(.*)$', re.M)
+
+def _file_offsets(filename):
+    """ Returns a dict mapping each card name in a data file to the byte
+        range (start, end) of its entry, which runs up to the next card's
+        Name: line. If a name appears twice, the first entry is used, as
+        with loading. """
+    with open(filename, 'rb') as f:
+        text = f.read()
+    offsets = {}
+    starts = [(m.start(), m.group(1)) for m in _name_line.finditer(text)]
+    ends = [start for start, _ in starts[1:]] + [len(text)]
+    for (start, name), end in zip(starts, ends):
+        offsets.setdefault(name.decode('utf-8').strip(), (start, end))
+    return offsets
+
+def card_hash(raw_card):
+    """ Returns a hex digest of a raw card entry (as from load()). """
+    return hashlib.sha1(raw_card.encode('utf-8')).hexdigest()
+
+def _card_name(raw_card):
+    return raw_card[5:raw_card.index('\n')].strip()
+
+def _file_hashes(filename):
+    """ Returns a dict mapping each card name in a data file to the
+        card_hash of its entry. If a name appears twice, the last entry is
+        used, as with updating. """
+    with open(filename) as f:
+        return {_card_name(rc): card_hash(rc)
+                for rc in _smart_split(f.read())}
+
+def _stat_key(filename):
+    st = os.stat(filename)
+    return st.st_size, st.st_mtime_ns
+
+def _per_file(kind, build, files=None):
+    """ Returns a dict mapping each data file to build(filename). The
+        results are kept in the cache under kind, and only redone for
+        files whose size or modification time changed. """
+    if not files:
+        files = TEXTFILES
+    saved = load_cache(kind, 1) or {}
+    result = {}
+    changed = False
+    for filename in files:
+        key = _stat_key(filename)
+        entry = saved.get(filename)
+        if not entry or entry[0] != key:
+            entry = saved[filename] = (key, build(filename))
+            changed = True
+        result[filename] = entry[1]
+    if changed:
+        save_cache(kind, 1, saved)
+    return result
+
+def load_offsets(files=None):
+    """ Returns a dict mapping each data file to the offsets of the cards
+        in it (see _file_offsets). """
+    return _per_file('offsets', _file_offsets, files)
+
+def load_hashes(files=None):
+    """ Returns a dict mapping each data file to the hashes of the cards
+        in it (see _file_hashes). """
+    return _per_file('hashes', _file_hashes, files)
+
 ## Updater ##
 
 _cost = re.compile(r'^([0-9WUBRGX]|\([0-9WUBRGPS]/[0-9WUBRGPS]\))+$', re.I)
@@ -186,61 +380,128 @@ class BasicTextParser:
                     s = s.replace('·', '\u2022')
                     self._rules_text.append(s)
 
-def _parse(text_data, ckpt_file, checkpoint):
+_openers = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+def open_dump(filename):
+    """ Opens a raw Oracle data file for reading as text, decompressing it
+        if its name ends in .gz, .bz2 or .xz. """
+    opener = _openers.get(os.path.splitext(filename)[1], open)
+    return opener(filename, 'rt', encoding='latin-1')
+
+def _chunks(lines, size):
+    """ Splits lines into lists of at least size lines (except the last),
+        each ending at a blank line, so that no card is split between two
+        chunks and each chunk can be parsed on its own. """
+    chunk = []
+    for line in lines:
+        blank = not line.strip()
+        if len(chunk) >= size and not blank and not chunk[-1].strip():
+            yield chunk
+            chunk = []
+        chunk.append(line)
+    if chunk:
+        yield chunk
+
+def _parse_chunk(lines):
     parser = BasicTextParser()
-    parser.parse_data(text_data)
-    result = parser.get_output()
-    if checkpoint:
-        with open(ckpt_file, 'w') as f:
-            f.write('\n\n'.join(result))
-    return result
+    parser.parse_data(lines)
+    return parser.get_output()
+
+def _parse_chunks(chunks, processes):
+    """ Yields the lists of cards parsed from each chunk, in order, using
+        the given number of worker processes (None for one per CPU).
+        Only a few chunks per process are read ahead. """
+    if processes == 1:
+        yield from map(_parse_chunk, chunks)
+        return
+    # Not forked, since this process may have threads running (eg. the
+    # log writer) that hold locks the workers would inherit.
+    ctx = multiprocessing.get_context('forkserver')
+    with concurrent.futures.ProcessPoolExecutor(processes, ctx) as ex:
+        window = collections.deque()
+        ahead = 2 * (processes or os.cpu_count() or 1)
+        for chunk in chunks:
+            window.append(ex.submit(_parse_chunk, chunk))
+            if len(window) > ahead:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
+
+def _parse(filename, ckpt_file, checkpoint, processes=1, chunk_size=20000):
+    """ Yields the cards parsed from a raw Oracle data file, as they're
+        parsed, writing each one to ckpt_file as well if checkpoint is
+        set. """
+    with contextlib.ExitStack() as stack:
+        f = stack.enter_context(open_dump(filename))
+        out = stack.enter_context(open(ckpt_file, 'w')) if checkpoint else None
+        sep = ''
+        for cards in _parse_chunks(_chunks(f, chunk_size), processes):
+            for raw_card in cards:
+                if out:
+                    out.write(sep + raw_card)
+                    sep = '\n\n'
+                yield raw_card
+
+def _text_file(name):
+    """ Returns the data file that the named card belongs in. """
+    initial = name[0] if name[0] in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ' else '0'
+    return os.path.join(DATADIR, "text", initial)
 
 def _update(raw_cards):
     """ Given a list of raw cards (in Oracle format, but already separated,
         eg. by _smart_split), update the text files in data/
-        by adding new card entries or updating existing entries. """
-    alpha = {}
-    # read in the data we already have
-    for tfile, rcs in load().items():
-        alpha[tfile[-1]] = {}
-        for raw_card in rcs:
-            name = raw_card[5:raw_card.index('\n')].strip()
-            alpha[tfile[-1]][name] = raw_card
-    added = 0
-    updated = 0
+        by adding new card entries or updating existing entries.
+        If a card appears more than once, the last one is used.
+
+        Cards are compared by hash against load_hashes(), so only the files
+        with a changed card are read and rewritten.
+        Returns the changeset, a dict with the sorted lists of names that
+        were 'added' and 'updated', and the 'files' rewritten. """
+    latest = {}
+    for raw_card in raw_cards:
+        raw_card = raw_card.strip()
+        latest[_card_name(raw_card)] = raw_card
+    hashes = load_hashes()
+    # filename -> {name: raw card} for each card that's new or changed
+    changes = {}
+    for name, raw_card in latest.items():
+        tfile = _text_file(name)
+        if hashes[tfile].get(name) != card_hash(raw_card):
+            changes.setdefault(tfile, {})[name] = raw_card
+    added = []
+    updated = []
     # Lines with whitespace only are junk
     differ = difflib.Differ(linejunk=lambda s: not s.strip())
     def sequencify(s):
         """ Make a sequence of lines that end in newlines. """
         return (s + '\n').splitlines(True)
-    # Sort the new data
-    for raw_card in raw_cards:
-        raw_card = raw_card.strip()
-        name = raw_card[5:raw_card.index('\n')].strip()
-        # TODO: factor out name -> filename function in case we decide
-        # to reorganize again?
-        initial = name[0] if name[0] in alpha else '0'
-        if name in alpha[initial]:
-            if alpha[initial][name] != raw_card:
-                updated += 1
-                diff = differ.compare(sequencify(alpha[initial][name]),
+    for tfile in sorted(changes):
+        with open(tfile) as f:
+            cards = {_card_name(rc): rc for rc in _smart_split(f.read())}
+        for name, raw_card in sorted(changes[tfile].items()):
+            if name in cards:
+                updated.append(name)
+                diff = differ.compare(sequencify(cards[name]),
                                       sequencify(raw_card))
                 dlog.info("Updating {}:\n{}"
                           .format(name, ''.join(diff)))
-        else:
-            added += 1
-            dlog.info("Adding {}.".format(name))
-        alpha[initial][name] = raw_card
-    # write out the data
-    for tfile in TEXTFILES:
-        with open(tfile, 'w') as f:
-            f.write('\n\n'.join(sorted(alpha[tfile[-1]].values())))
+            else:
+                added.append(name)
+                dlog.info("Adding {}.".format(name))
+            cards[name] = raw_card
+        with replacing(tfile) as f:
+            f.write('\n\n'.join(sorted(cards.values())))
             f.write('\n')
-    # The update count might include those with no changes.
-    # But this usually doesn't happen, as reprinted cards get a new expansion.
-    summary = ("Added {} new cards and updated {} old ones."
-               .format(added, updated))
+    if changes:
+        load_hashes()
+        load_offsets()
+    summary = ("Added {} new cards and updated {} old ones, "
+               "rewriting {} of {} files."
+               .format(len(added), len(updated), len(changes),
+                       len(TEXTFILES)))
     ulog.info(summary)
+    return {'added': sorted(added), 'updated': sorted(updated),
+            'files': sorted(changes)}
 
 def add_subcommands(subparsers):
     """ Adds the 'update' command to the main parser.
@@ -257,7 +518,10 @@ def add_subcommands(subparsers):
     group.add_argument('-p', '--parse', nargs='+', metavar='INFILE',
         help=('Raw data, from eg. http://www.yawgatog.com/resources/oracle/, '
               'which will be parsed and modified into the format demystify '
-              'expects.'))
+              'expects. Files ending in .gz, .bz2 or .xz are decompressed.'))
+    subparser.add_argument('-j', '--jobs', type=int, default=1,
+        help=('Parse the raw data with this many worker processes '
+              '(0 for one per CPU).'))
     subparser.add_argument('--checkpoint-dir', metavar='CKPT_DIR',
         dest='ckpt_dir', default='/tmp/demystify',
         help=('With --checkpoint-requests and/or --checkpoint-parsing, '
@@ -270,6 +534,9 @@ def add_subcommands(subparsers):
         help=('Quit immediately after the last checkpoint instead of '
               'continuing to the next step. No effect without '
               '--checkpoint-parsing.'))
+    subparser.add_argument('--changeset', metavar='FILE',
+        help=('Write the names of the cards added and updated, and the '
+              'data files rewritten, to FILE as JSON.'))
     subparser.set_defaults(func=run_update)
 
 def run_update(args):
@@ -279,18 +546,23 @@ def run_update(args):
         if not os.path.exists(args.ckpt_dir):
             os.makedirs(args.ckpt_dir)
     skip_update = args.checkpoint_only and args.checkpoint_parsing
-    card_data = []
     if args.update:
         skip_update = False
-        for raw_cards in load(args.update).values():
-            card_data.extend(raw_cards)
+        card_data = itertools.chain.from_iterable(load(args.update).values())
     else:
-        for filename in args.parse:
-            cfile = os.path.join(args.ckpt_dir, os.path.basename(filename))
-            with open(filename, encoding='latin-1') as f:
-                raw_cards = _parse(f, cfile, args.checkpoint_parsing)
-                card_data.extend(raw_cards)
+        card_data = itertools.chain.from_iterable(
+            _parse(filename,
+                   os.path.join(args.ckpt_dir, os.path.basename(filename)),
+                   args.checkpoint_parsing, args.jobs or None)
+            for filename in args.parse)
 
     # Finally, run the update.
-    if not skip_update:
-        _update(card_data)
+    if skip_update:
+        # Parse everything, for the checkpoint files.
+        collections.deque(card_data, maxlen=0)
+    else:
+        changeset = _update(card_data)
+        if args.changeset:
+            with replacing(args.changeset) as f:
+                json.dump(changeset, f, indent=1, sort_keys=True)
+                f.write('\n')
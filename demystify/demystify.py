@@ -19,12 +19,14 @@
 """demystify -- A Magic: The Gathering parser."""
 
 import argparse
+import collections
+import contextlib
+import functools
 import logging
+import os
 import re
 
-logging.basicConfig(level=logging.DEBUG, filename="LOG", filemode="w")
 plog = logging.getLogger("Parser")
-plog.setLevel(logging.DEBUG)
 _stdout = logging.StreamHandler()
 _stdout.setLevel(logging.WARNING)
 _stdout.setFormatter(logging.Formatter(fmt='%(levelname)s: %(message)s'))
@@ -35,6 +37,10 @@ import antlr3
 import card
 import data
 from grammar import DemystifyLexer, DemystifyParser
+import index
+import logs
+import memo
+import streams
 import test
 
 # What we don't handle:
@@ -54,24 +60,117 @@ def get_cards():
 
 ## Lexer / Parser entry points ##
 
-def _token_stream(name, text):
-    """ Helper method for generating a token stream from text. """
-    char_stream = antlr3.ANTLRStringStream(text)
-    lexer = DemystifyLexer.DemystifyLexer(char_stream)
+streams.LeanToken.names = DemystifyParser.tokenNames
+
+# The generated modules take a while to import, so the card workers start
+# with them (and this module) already imported.
+card.preload(__name__, 'grammar.DemystifyLexer', 'grammar.DemystifyParser')
+
+# How text is lexed for the parser (see _token_stream and the token corpus):
+# 'common', with whitespace tokens on the hidden channel, or 'lean', without
+# them (set by --lean-lexing). Error messages and error nodes show token
+# indexes, which differ without whitespace tokens, so this is part of the
+# key of anything derived from the tokens.
+LEXING = 'common'
+
+@functools.lru_cache()
+def _recognizer():
+    """ Returns the parser and lexer classes of the recognition-only build of
+        the grammar (see recognize.py). As long as the two builds number
+        their tokens alike, the lexer is the full build's, so that the
+        token corpus serves both. """
+    try:
+        from grammar.recognizer import (DemystifyRecognizerLexer,
+                                        DemystifyRecognizerParser)
+    except ImportError:
+        raise ImportError('The recognition-only parser has not been built: '
+                          'run recognize.py, then antlr3 on '
+                          'grammar/recognizer/DemystifyRecognizer.g.'
+                          ) from None
+    Parser = DemystifyRecognizerParser.DemystifyRecognizerParser
+    if DemystifyRecognizerParser.tokenNames == DemystifyParser.tokenNames:
+        Lexer = DemystifyLexer.DemystifyLexer
+    else:
+        Lexer = DemystifyRecognizerLexer.DemystifyRecognizerLexer
+    return Parser, Lexer
+
+def _token_stream(name, text, start=0, stop=None, codes=None, lean=None,
+                  recognize=False, line=1):
+    """ Helper method for generating a token stream from text, or from
+        text[start:stop], whose first line is numbered line
+        (see streams.TextStream).
+        With lean (by default, if LEXING is 'lean'), whitespace is dropped
+        rather than put on the hidden channel, and the tokens are
+        streams.LeanTokens.
+        With recognize, the tokens are for the recognition-only parser. """
+    if lean is None:
+        lean = LEXING == 'lean'
+    char_stream = streams.TextStream(text, start, stop, codes, line)
+    if recognize:
+        Lexer = _recognizer()[1]
+    else:
+        Lexer = DemystifyLexer.DemystifyLexer
+    if lean:
+        Lexer = streams.lean_lexer(Lexer)
+    lexer = streams.recognizers.get(Lexer, char_stream)
     lexer.card = name
-    # tokenizes completely and logs on errors
-    return antlr3.CommonTokenStream(lexer)
+    if lean:
+        ts = streams.LeanTokenStream(lexer, text[start:stop])
+    else:
+        ts = antlr3.CommonTokenStream(lexer)
+    # Tokenize completely (logging any errors) before the lexer is reused.
+    ts.fillBuffer()
+    return ts
 
+@card.uses_fields('name', 'rules')
 def _lex(c):
-    try:
-        tokens = _token_stream(c.name, c.rules).getTokens()
-    except:
-        print('Error lexing {}:\n{}'.format(c.name, c.rules))
-        raise
+    """ Lexes each line of a card's text. Returns a list of
+        (line, packed tokens) for the token corpus. """
+    result = []
+    codes = streams.code_points(c.rules)
+    start = 0
+    for lineno, line in enumerate(c.rules.split('\n'), 1):
+        stop = start + len(line)
+        try:
+            ts = _token_stream(c.name, c.rules, start, stop, codes,
+                               line=lineno)
+            tokens = ts.getTokens()
+        except:
+            print('Error lexing {}:\n{}'.format(c.name, c.rules))
+            raise
+        if ts.tokenSource.getNumberOfSyntaxErrors():
+            result.append((line, None))
+        else:
+            result.append((line, streams.pack_tokens(line, tokens)))
+        start = stop + 1
+    return result
 
 def test_lex(cards):
-    """ Test the lexer against the given cards' text, logging failures. """
-    card.map_multi(_lex, cards)
+    """ Test the lexer against the given cards' text, logging failures.
+        The tokens are kept in the token corpus. """
+    get_token_corpus(cards, relex=True)
+
+_token_corpus = None
+
+def get_token_corpus(cards=(), relex=False):
+    """ Returns the token corpus for the current lexer build, after lexing
+        the lines of the given cards that it doesn't have yet (or all of
+        them, with relex). The card workers are sent the corpus whenever it
+        has changed (see the worker state registered below). """
+    global _token_corpus
+    if _token_corpus is None:
+        _token_corpus = streams.TokenCorpus.load((memo.lexer_hash(),
+                                                  LEXING))
+    if not relex:
+        cards = [c for c in cards
+                 if any(line not in _token_corpus
+                        for line in c.rules.split('\n'))]
+    if cards:
+        for lines in card.map_multi(_lex, cards):
+            for line, packed in lines:
+                _token_corpus.add(line, packed)
+        _token_corpus.save()
+    return _token_corpus
 
 def test_lex_s(cards):
     """ Test the lexer against the given cards' text, logging failures. """
@@ -82,11 +181,13 @@ def test_lex_s(cards):
             print('Error lexing {}:\n{}'.format(c.name, c.rules))
             raise
 
-def lex_card(c):
-    """ Test the lexer against one card's text. """
+def lex_card(c, lean=None):
+    """ Test the lexer against one card's text. lean is as for
+        _token_stream: with lean False, the tokens are numbered as they are
+        with whitespace tokens. """
     if isinstance(c, str):
         c = card.get_card(c)
-    tokens = _token_stream(c.name, c.rules).getTokens()
+    tokens = _token_stream(c.name, c.rules, lean=lean).getTokens()
     print(c.rules)
     pprint_tokens(tokens)
 
@@ -115,64 +216,332 @@ def parse_card(c):
     print(parse_result.tree.toStringTree())
     # TODO: rules text
 
-def _parse(rule, text, name, lineno=None):
-    ts = _token_stream(name, text)
+def _parse(rule, text, name, lineno=None, ts=None, recognize=False):
+    if ts is None:
+        ts = _token_stream(name, text, recognize=recognize)
     if lineno:
         ts.line = lineno
-    p = DemystifyParser.DemystifyParser(ts)
+    if recognize:
+        Parser = _recognizer()[0]
+    else:
+        Parser = DemystifyParser.DemystifyParser
+    p = streams.recognizers.get(Parser, ts, rule)
     p.setCardState(name)
     return p, getattr(p, rule)()
 
-def test_parse(rule, text, name=''):
-    """ Give the starting rule and try to parse text. """
-    ts = _token_stream(name or 'Sample text', text)
-    p = DemystifyParser.DemystifyParser(ts)
+# The number of token streams _corpus_view gave from the token corpus, and
+# the number of times it couldn't, so the text had to be lexed, in this
+# process.
+_corpus_counts = collections.Counter()
+
+def _corpus_view(source, name, recognize=False):
+    """ Returns a token stream from the token corpus for source (see
+        _parse_result), or None if it can't give one. """
+    ts = None
+    if (source and _token_corpus is not None
+        and not (recognize and _recognizer()[1]
+                 is not DemystifyLexer.DemystifyLexer)):
+        ts = _token_corpus.view(*source, name=name)
+    _corpus_counts['views' if ts else 'lexed'] += 1
+    return ts
+
+_memo = None
+
+def _memo_build():
+    """ The build key of the parse memo: the grammar build and LEXING. """
+    return '{}:{}'.format(memo.grammar_hash(), LEXING)
+
+def get_memo():
+    """ Returns the parse memo for the current grammar build. """
+    global _memo
+    if _memo is None:
+        _memo = memo.ParseMemo(os.path.join(data.CACHEDIR, 'parses.sqlite'),
+                               _memo_build())
+    return _memo
+
+## State for the card workers ##
+
+def _set_lexing(lexing):
+    global LEXING
+    LEXING = lexing
+
+def _set_token_corpus(corpus):
+    global _token_corpus
+    _token_corpus = corpus
+
+def _set_memo(m):
+    global _memo
+    _memo = m
+
+# The card workers are sent these whenever they change, so that they lex
+# the same way, take tokens from the same corpus and share the parse memo,
+# whose build key is only worked out here.
+card.worker_state('lexing', lambda: LEXING, lambda: LEXING, _set_lexing)
+card.worker_state('token corpus',
+                  lambda: _token_corpus and (id(_token_corpus),
+                                             len(_token_corpus._lines)),
+                  lambda: _token_corpus, _set_token_corpus)
+card.worker_state('parse memo', lambda: id(_memo), lambda: _memo, _set_memo)
+
+def _parse_result(rule, text, name, lineno=None, source=None):
+    """ Parses text with the given rule, logging its errors, and returns
+        the memo.ParseResult, without using the parse memo.
+
+        source, if given, is (line, start, stop) such that text is
+        line[start:stop], so that the parser can be given the tokens from
+        the token corpus (if it has been loaded) instead of lexing text. """
+    with logs.capture('Lexer', 'Parser') as records:
+        ts = _corpus_view(source, name)
+        p, parse_result = _parse(rule, text, name, lineno, ts)
+    tree = parse_result.tree
+    errors = p.getNumberOfSyntaxErrors()
+    mcase = None
+    if errors:
+        mcase = _crawl_tree_for_errors(name, lineno, text, tree)
+    # Error messages start with the card name, which may differ next time.
+    prefix = '{}:'.format(name)
+    messages = []
+    for r in records:
+        msg = r.getMessage()
+        named = msg.startswith(prefix)
+        messages.append((r.name, r.levelno, named,
+                         msg[len(prefix):] if named else msg))
+    return memo.ParseResult(tree.toStringTree(), errors, mcase,
+                            tuple(messages))
+
+def _memo_parse(rule, text, name, lineno=None, source=None):
+    """ Returns the memo.ParseResult of parsing text with the given rule,
+        only invoking the parser if the memo doesn't already have it.
+        Either way, the errors from parsing text are logged.
+        source is as for _parse_result. """
+    m = get_memo()
+    result = m.get(rule, text)
+    if result is not None:
+        if result.errors or result.messages:
+            _replay_errors(name, lineno, text, result)
+        return result
+    result = _parse_result(rule, text, name, lineno, source)
+    m.put(rule, text, result)
+    return result
+
+def _replay_errors(name, lineno, text, result):
+    """ Logs what parsing text logged when result was put in the memo, and
+        what _crawl_tree_for_errors logged for it, as if it had just been
+        parsed for the given card and line. """
+    for logger, level, named, msg in result.messages:
+        if named:
+            msg = '{}:{}'.format(name, msg)
+        logging.getLogger(logger).log(level, '%s', msg)
+    if not result.errors:
+        return
+    if plog.isEnabledFor(logging.DEBUG):
+        plog.debug('%s:%s:text:%s', name, lineno, text)
+        plog.debug('%s:%s:result:%s', name, lineno, result.tree)
+    if result.case == '':
+        plog.warning('{}:{}:Empty case detected!'.format(name, lineno))
+
+# card: the card name
+# line: the line number in the card's text
+# text: the text that failed to parse
+# start: the position in text of the token at the first syntax error
+# stack: the rule invocation stack at that error
+ScanFailure = collections.namedtuple('ScanFailure',
+                                     'card line text start stack')
+
+def _recognize_parse(rule, text, name, lineno=None, source=None):
+    """ Parses text with the given rule using the recognition-only parser,
+        which builds no tree, and returns the number of syntax errors.
+        The parse memo is neither used nor updated. source is as for
+        _parse_result. """
+    ts = _corpus_view(source, name, recognize=True)
+    p, _ = _parse(rule, text, name, lineno, ts, recognize=True)
+    return p.getNumberOfSyntaxErrors()
+
+def _scan_parse(rule, text, name, lineno=None, source=None,
+                recognize=False, memoize=True):
+    """ Parses text with the given rule in fail-fast mode, stopping at the
+        first syntax error. Returns None if it parses, or a ScanFailure.
+        With memoize, text the parse memo already knows to parse isn't
+        parsed again. source is as for _parse_result. With recognize, the
+        parse is done with the recognition-only parser. """
+    if memoize:
+        result = get_memo().get(rule, text)
+        if result is not None and not result.errors:
+            return None
+    ts = _corpus_view(source, name, recognize)
+    if ts is None:
+        ts = _token_stream(name, text, recognize=recognize)
+    if recognize:
+        Parser = _recognizer()[0]
+    else:
+        Parser = DemystifyParser.DemystifyParser
+    p = streams.recognizers.get(Parser, ts, rule)
     p.setCardState(name)
-    result = getattr(p, rule)()
+    p._state.failFast = True
+    try:
+        getattr(p, rule)()
+    except antlr3.Parser.SyntaxStop as e:
+        return ScanFailure(name, lineno, text, _error_start(text, e.token),
+                           e.stack)
+    return None
+
+def _error_start(text, token):
+    """ The position in text of token, the token at a syntax error, or the
+        end of text if there is none (eg. at EOF). """
+    start = token.start if token is not None else None
+    if start is None or start < 0:
+        start = len(text)
+    return start
+
+def _error_case(text, start):
+    """ The unique error case for a syntax error at position start in
+        text: the text from there up to the next comma. """
+    end = text.find(',', start)
+    return text[start:end if end >= 0 else len(text)]
+
+def _failure_case(f):
+    """ The unique error case of a ScanFailure, taken at the first syntax
+        error. A full parse (see _crawl_tree_for_errors) takes it at the
+        first error node of the tree instead, which is usually the same
+        error, but not when the parser recovered from an earlier one
+        without making an error node (eg. by deleting a token). """
+    return _error_case(f.text, f.start)
+
+def _print_memo_stats(hits, misses):
+    print('Parse memo: {} hits, {} misses.'.format(hits, misses))
+
+def test_parse(rule, text, name='', recognize=False, memoize=False):
+    """ Give the starting rule and try to parse text.
+        Returns the parser's result. With memoize, the result is looked up
+        in the parse memo (and put there), and is the memo.ParseResult,
+        whose tree is a string. With recognize, returns the number of
+        syntax errors from the recognition-only parser. """
+    name = name or 'Sample text'
+    if recognize:
+        errors = _recognize_parse(rule, text, name)
+        print(text)
+        print('{} errors.'.format(errors))
+        return errors
+    ts = _token_stream(name, text)
+    if memoize:
+        result = _memo_parse(rule, text, name)
+        tree = result.tree
+    else:
+        _, result = _parse(rule, text, name, ts=ts)
+        tree = result.tree.toStringTree()
     print(text)
     pprint_tokens(ts.getTokens())
-    print(result.tree.toStringTree())
+    print(tree)
     return result
 
-def parse_all(cards):
-    """ Run the parser against each card's parseable parts. """
+def parse_all(cards, memoize=False):
+    """ Run the parser against each card's parseable parts, saving each
+        result tree to the card's parsed_{part}. With memoize, the results
+        come from the parse memo (and are put there), and the trees saved
+        are strings. """
     # card attribute -> parser rule
     parts = { 'cost' : 'card_mana_cost',
               'typeline' : 'typeline' }
     errors = 0
+    if memoize:
+        hits, misses = get_memo().stats()
     for c in card.CardProgressBar(cards):
         for part, rule in parts.items():
             a = getattr(c, part)
             if a:
-                p, parse_result = _parse(rule, a, c.name)
-                setattr(c, 'parsed_' + part, parse_result.tree)
-                if p.getNumberOfSyntaxErrors():
-                    plog.debug('result: ' + parse_result.tree.toStringTree())
+                if memoize:
+                    result = _memo_parse(rule, a, c.name)
+                    tree = result.tree
+                    failed = result.errors
+                else:
+                    p, parse_result = _parse(rule, a, c.name)
+                    tree = parse_result.tree
+                    failed = p.getNumberOfSyntaxErrors()
+                setattr(c, 'parsed_' + part, tree)
+                if failed:
+                    plog.debug('result: %s', tree if memoize
+                                             else tree.toStringTree())
                     errors += 1
     print('{} total errors.'.format(errors))
+    if memoize:
+        h, m = get_memo().stats()
+        _print_memo_stats(h - hits, m - misses)
 
 def _crawl_tree_for_errors(name, lineno, text, tree):
     """ Common helper function for gathering errors.
-        Logs error text and returns a unique error case for the
-        first encountered error. """
-    plog.debug('{}:{}:text:{}'.format(name, lineno, text))
-    plog.debug('{}:{}:result:{}'.format(name, lineno, tree.toStringTree()))
+        Logs error text and returns the unique error case (see _error_case)
+        for the first error node in the tree, breadth-first. """
+    if plog.isEnabledFor(logging.DEBUG):
+        plog.debug('%s:%s:text:%s', name, lineno, text)
+        plog.debug('%s:%s:result:%s', name, lineno, tree.toStringTree())
     queue = [tree]
     while queue:
         n = queue.pop(0)
         if n.children:
             queue.extend(n.children)
         if isinstance(n, antlr3.tree.CommonErrorNode):
-            mstart = n.trappedException.token.start
-            mend = text.find(',', mstart)
-            if mend < 0:
-                mend = len(text)
-            mcase = text[mstart:mend]
+            mcase = _error_case(text, n.trappedException.token.start)
             if not mcase:
                 plog.warning('{}:{}:Empty case detected!'.format(name, lineno))
             return mcase
 
-def parse_helper(cards, name, rulename, yesregex=None, noregex=None):
+@card.uses_fields('name', 'rules')
+def _parse_helper(rulename, yesregex, noregex, c, coverage=False,
+                  recognize=False, memoize=True):
+    """ Parses the parts of one card's text selected by yesregex and noregex
+        (see parse_helper) with the given rule, using the parse memo if
+        memoize is set.
+
+        Returns a tuple (card name, result trees, number of errors,
+        set of unique errors, parse memo hits, parse memo misses,
+        texts given tokens from the token corpus, texts lexed).
+        With coverage, the results are the ScanFailures instead of trees.
+        Otherwise, with recognize, they are the numbers of errors, and no
+        unique errors are found. """
+    results = []
+    errors = 0
+    uerrors = set()
+    hits, misses = get_memo().stats() if memoize else (0, 0)
+    views, lexed = _corpus_counts['views'], _corpus_counts['lexed']
+    for lineno, line in enumerate(c.rules.split('\n')):
+        lineno += 1
+        if yesregex:
+            spans = [m.span(1) if m.groups() else m.span(0)
+                     for m in yesregex.finditer(line)]
+        else:
+            spans = [(0, len(line))]
+        if noregex:
+            spans = [(a, b) for a, b in spans
+                     if not noregex.match(line[a:b])]
+        for a, b in spans:
+            if coverage:
+                failure = _scan_parse(rulename, line[a:b], c.name, lineno,
+                                      (line, a, b), recognize, memoize)
+                if failure:
+                    results.append(failure)
+                    uerrors.add(_failure_case(failure))
+                    errors += 1
+                continue
+            if recognize:
+                e = _recognize_parse(rulename, line[a:b], c.name, lineno,
+                                     (line, a, b))
+                results.append(e)
+                if e:
+                    errors += 1
+                continue
+            parse = _memo_parse if memoize else _parse_result
+            result = parse(rulename, line[a:b], c.name, lineno, (line, a, b))
+            results.append(result.tree)
+            if result.errors:
+                if result.case:
+                    uerrors.add(result.case)
+                errors += 1
+    h, m = get_memo().stats() if memoize else (0, 0)
+    return (c.name, results, errors, uerrors, h - hits, m - misses,
+            _corpus_counts['views'] - views, _corpus_counts['lexed'] - lexed)
+
+def parse_helper(cards, name, rulename, yesregex=None, noregex=None,
+                 coverage=False, recognize=False, memoize=True):
     """ Parse a given subset of text on a given subset of cards.
 
         This function may override some re flags on the
@@ -189,32 +558,24 @@ def parse_helper(cards, name, rulename, yesregex=None, noregex=None):
             group 0 (the entire match) otherwise. If not provided, use each
             line in its entirety.
         noregex: Any text found after considering yesregex (or its absence)
-            is skipped if it matches this regex. """
-    def _parse_helper(c):
-        """ Returns a pair (number of errors, set of unique errors). """
-        results = []
-        errors = 0
-        uerrors = set()
-        for lineno, line in enumerate(c.rules.split('\n')):
-            lineno += 1
-            if yesregex:
-                texts = [m.group(1) if m.groups() else m.group(0)
-                         for m in yesregex.finditer(line)]
-            else:
-                texts = [line]
-            if noregex:
-                texts = [text for text in texts if not noregex.match(text)]
-            for text in texts:
-                p, parse_result = _parse(rulename, text, c.name, lineno)
-                tree = parse_result.tree
-                results.append(tree)
-                if p.getNumberOfSyntaxErrors():
-                    mcase = _crawl_tree_for_errors(c.name, lineno, text, tree)
-                    if mcase:
-                        uerrors.add(mcase)
-                    errors += 1
-        return (c.name, [t.toStringTree() for t in results], errors, uerrors)
-    _parse_helper.__name__ = '_parse_{}'.format(name)
+            is skipped if it matches this regex.
+        coverage: If set, only find out which texts fail to parse: each
+            text is parsed in fail-fast mode, which stops at the first
+            syntax error, and no results are saved to the cards. Returns
+            the list of ScanFailures. Unique cases are taken at that error
+            (see _failure_case).
+        recognize: If set, parse with the recognition-only parser (see
+            recognize.py), which accepts and rejects the same text but
+            builds no trees. The results saved to the cards are the numbers
+            of syntax errors, and unique cases aren't found except with
+            coverage.
+        memoize: If set (the default), results are looked up in the parse
+            memo before parsing, and put there after. Otherwise, every text
+            is parsed, and the memo is neither read nor written. """
+    func = functools.partial(_parse_helper, rulename, yesregex, noregex,
+                             coverage=coverage, recognize=recognize,
+                             memoize=memoize)
+    func.__name__ = '_parse_{}'.format(name)
 
     if yesregex:
         pattern = yesregex.pattern
@@ -235,18 +596,40 @@ def parse_helper(cards, name, rulename, yesregex=None, noregex=None):
     errors = 0
     uerrors = set()
     plog.removeHandler(_stdout)
-    # list of (cardname, parsed result trees, number of errors, set of errors)
-    results = card.map_multi(_parse_helper, ccards)
+    # Find the grammar build hash once, rather than in every worker,
+    # and lex any lines we haven't before, so the workers needn't.
+    if memoize:
+        get_memo()
+    get_token_corpus(ccards)
+    hits = misses = views = lexed = 0
+    # list of (cardname, parsed result trees, number of errors, set of errors,
+    #          memo hits, memo misses, corpus views, texts lexed)
+    results = card.map_multi(func, ccards)
     cprop = 'parsed_{}'.format(name)
-    for cname, pc, e, u in results:
-        setattr(card.get_card(cname), cprop, pc)
+    failures = []
+    for cname, pc, e, u, h, m, v, l in results:
+        if coverage:
+            failures.extend(pc)
+        else:
+            setattr(card.get_card(cname), cprop, pc)
         errors += e
         uerrors |= u
+        hits += h
+        misses += m
+        views += v
+        lexed += l
     plog.addHandler(_stdout)
     print('{} total errors.'.format(errors))
+    if memoize:
+        _print_memo_stats(hits, misses)
+    print('Token corpus: {} texts given tokens, {} lexed.'
+          .format(views, lexed))
     if uerrors:
         print('{} unique cases missing.'.format(len(uerrors)))
-        plog.debug('Missing cases: ' + '; '.join(sorted(uerrors)))
+        if plog.isEnabledFor(logging.DEBUG):
+            plog.debug('Missing cases: %s', '; '.join(sorted(uerrors)))
+    if coverage:
+        return failures
 
 # All costs come before a colon, but these may occur at the start of a line,
 # after an mdash, or after an opening quote for an ability.
@@ -262,40 +645,157 @@ levels = re.compile(r'^{level')
 # or sentence.
 triggerregex = re.compile(r"""(?:^|— | "| '|\. )when(?:ever)? ([^,]*),""")
 
-def parse_ability_costs(cards):
+def parse_ability_costs(cards, coverage=False, recognize=False,
+                        memoize=True):
     """ Find all ability costs in the cards and attempt to parse them. """
-    parse_helper(cards, 'costs', 'cost', yesregex=costregex, noregex=levels)
+    return parse_helper(cards, 'costs', 'cost', yesregex=costregex,
+                        noregex=levels, coverage=coverage,
+                        recognize=recognize, memoize=memoize)
 
-def parse_keyword_lines(cards):
+def parse_keyword_lines(cards, coverage=False, recognize=False,
+                        memoize=True):
     """ Parse all lines in the cards that are lists of keywords. """
-    parse_helper(cards, 'keywords', 'keywords', noregex=keywordskipregex)
+    return parse_helper(cards, 'keywords', 'keywords',
+                        noregex=keywordskipregex, coverage=coverage,
+                        recognize=recognize, memoize=memoize)
 
-def parse_triggers(cards):
+def parse_triggers(cards, coverage=False, recognize=False, memoize=True):
     """ Parse all trigger conditions in the cards. """
-    parse_helper(cards, 'triggers', 'triggers', yesregex=triggerregex,
-                 noregex=levels)
+    return parse_helper(cards, 'triggers', 'triggers', yesregex=triggerregex,
+                        noregex=levels, coverage=coverage,
+                        recognize=recognize, memoize=memoize)
+
+@contextlib.contextmanager
+def _empty_registry():
+    """ Runs the body with an empty card registry, then puts the current
+        one back. """
+    registry = ('_all_cards', 'all_names', 'all_names_inv', 'all_shortnames',
+                'cards_by_set', '_card_ids', '_card_list')
+    saved = {n: getattr(card, n)
+             for n in registry + ('_card_indexes', '_text_index')}
+    for n in registry:
+        setattr(card, n, type(saved[n])())
+    card._card_indexes = None
+    card._text_index = None
+    try:
+        yield
+    finally:
+        for name, v in saved.items():
+            setattr(card, name, v)
+
+def bench_card_memory():
+    """ Measure the memory taken by the cards, by loading the card data
+        again into an empty registry while tracing allocations.
+        The current registry is put back afterward. """
+    import tracemalloc
+    raw_cards = [rc for clist in data.load().values() for rc in clist]
+    with _empty_registry():
+        tracemalloc.start()
+        try:
+            before = tracemalloc.take_snapshot()
+            for rc in raw_cards:
+                card.Card.from_string(rc)
+            after = tracemalloc.take_snapshot()
+            n = len(card._all_cards)
+        finally:
+            tracemalloc.stop()
+    size = sum(s.size_diff for s in after.compare_to(before, 'filename'))
+    print('{} cards: {:.1f} MiB, {:.0f} bytes per card.'
+          .format(n, size / 2**20, size / n))
+
+def bench_load(repeat=3):
+    """ Time loading the card data files into an empty registry, with
+        data.load and Card.from_string, and with Card.load_all.
+        The current registry is put back afterward. """
+    import time
+
+    def split_load():
+        for clist in data.load().values():
+            for rc in clist:
+                card.Card.from_string(rc)
+
+    def scan_load():
+        for _ in card.Card.load_all():
+            pass
+
+    for name, load in [('load/from_string', split_load),
+                       ('load_all', scan_load)]:
+        best = None
+        for _ in range(repeat):
+            with _empty_registry():
+                start = time.perf_counter()
+                load()
+                t = time.perf_counter() - start
+                n = len(card._all_cards)
+            best = t if best is None else min(best, t)
+        print('{}: {} cards in {:.3f}s, {:.0f} cards/s.'
+              .format(name, n, best, n / best))
+
+def _snapshot_key():
+    """ The card snapshot depends on the card data and on the code that
+        loads and preprocesses it (including BANNED, here). """
+    return data.content_hash(*(data.TEXTFILES + [card.__file__,
+                                                 index.__file__,
+                                                 data.__file__, __file__]))
 
 def preprocess(args):
-    raw_cards = []
-    for clist in data.load().values():
-        raw_cards.extend(clist)
-    numcards = len(raw_cards)
-    for rc in raw_cards:
-        _ = card.Card.from_string(rc)
+    key = _snapshot_key()
+    state = None if args.no_cache else data.load_cache('snapshot', key)
+    if state:
+        card.restore(state)
+    else:
+        _load_and_preprocess(args.jobs or None)
+        data.save_cache('snapshot', key, card.snapshot())
+    if args.interactive:
+        # Start the card workers now, rather than on the first map_multi.
+        card.get_pool()
+        import code
+        code.interact(local=globals())
+
+def _load_and_preprocess(processes=1):
+    # Names are found and split with index.NameMatcher and index.NameTrie.
+    version = data.content_hash(card.__file__, index.__file__)
+    records = data.load_cache('preprocess', version)
+    numcards = 0
+    if processes == 1:
+        for _ in card.Card.load_all():
+            numcards += 1
+        legalcards = get_cards()
+        records = card.preprocess_all(legalcards, records)
+    else:
+        # Every card name is in the data file indexes, so the workers can
+        # preprocess cards as they are loaded.
+        names = {name for offsets in data.load_offsets().values()
+                 for name in offsets}
+        card.register_names(names)
+
+        def load():
+            nonlocal numcards
+            seen = set()
+            for c in card.Card.load_all():
+                numcards += 1
+                if c.name not in seen and c.name not in BANNED:
+                    seen.add(c.name)
+                    yield c
+
+        records = card.preprocess_all(load(), records, processes,
+                                      len(names - set(BANNED)))
+        legalcards = get_cards()
+    data.save_cache('preprocess', version, records)
     cards = card.get_cards()
-    split = {c.name for c in cards if c.multitype == "split"}
-    xsplit = {c.multicard for c in cards if c.multitype == "split"}
-    logging.debug("Split cards: " + "; ".join(sorted(split)))
+    split = {c.name for c in card.find_cards(multitype="split")}
+    xsplit = {c.multicard for c in card.find_cards(multitype="split")}
+    logging.debug("Split cards: %s", "; ".join(sorted(split)))
     if split != xsplit:
         logging.error("Difference: " + "; ".join(split ^ xsplit))
-    flip = {c.name for c in cards if c.multitype == "flip"}
-    xflip = {c.multicard for c in cards if c.multitype == "flip"}
-    logging.debug("Flip cards: " + "; ".join(sorted(flip)))
+    flip = {c.name for c in card.find_cards(multitype="flip")}
+    xflip = {c.multicard for c in card.find_cards(multitype="flip")}
+    logging.debug("Flip cards: %s", "; ".join(sorted(flip)))
     if flip != xflip:
         logging.error("Difference: " + "; ".join(flip ^ xflip))
-    trans = {c.name for c in cards if c.multitype == "transform"}
-    xtrans = {c.multicard for c in cards if c.multitype == "transform"}
-    logging.debug("Transform cards: " + "; ".join(sorted(trans)))
+    trans = {c.name for c in card.find_cards(multitype="transform")}
+    xtrans = {c.multicard for c in card.find_cards(multitype="transform")}
+    logging.debug("Transform cards: %s", "; ".join(sorted(trans)))
     if trans != xtrans:
         logging.error("Difference: " + "; ".join(trans ^ xtrans))
     s = int(len(split) / 2)
@@ -304,28 +804,61 @@ def preprocess(args):
     logging.info("Discovered {} unique (physical) cards, from {}, including "
                  "{} split cards, {} flip cards, and {} transform cards."
                  .format(len(cards) - s - f - t, numcards, s, f, t))
-    legalcards = get_cards()
     logging.info("Found {} banned cards.".format(len(cards) - len(legalcards)))
     if len(cards) - len(legalcards) != len(BANNED):
         logging.warning("...but {} banned cards were named."
                         .format(len(BANNED)))
-    card.preprocess_all(legalcards)
-    if args.interactive:
-        import code
-        code.interact(local=globals())
+
+def show_card(args):
+    """ Builds a single card straight from the data files, without loading
+        the rest, and shows it, lexes it, or parses it. """
+    card.open_store()
+    c = card.get_card(args.name)
+    if c is None:
+        logging.error('No card named {!r}.'.format(args.name))
+        return
+    c.rules = card.preprocess_card(c)
+    if args.lex:
+        lex_card(c)
+    elif args.parse:
+        parse_card(c)
+    else:
+        print(c)
 
 def main():
     parser = argparse.ArgumentParser(
         description='A Magic: the Gathering parser.')
+    logs.add_arguments(parser)
+    parser.add_argument('--lean-lexing', action='store_true',
+                        help=('Lex without whitespace tokens, which takes '
+                              'less time and memory. Token indexes in parse '
+                              'errors then differ from the default.'))
     subparsers = parser.add_subparsers()
     data.add_subcommands(subparsers)
     test.add_subcommands(subparsers)
     loader = subparsers.add_parser('load')
     loader.add_argument('-i', '--interactive', action='store_true',
                         help='Enter interactive mode instead of exiting.')
+    loader.add_argument('--no-cache', action='store_true',
+                        help=('Ignore any saved snapshot of the card data '
+                              'and load and preprocess the cards again.'))
+    loader.add_argument('-j', '--jobs', type=int, default=1,
+                        help=('Preprocess the cards with this many worker '
+                              'processes (0 for one per CPU).'))
     loader.set_defaults(func=preprocess)
+    shower = subparsers.add_parser('card')
+    shower.add_argument('name', help='The name of the card.')
+    group = shower.add_mutually_exclusive_group()
+    group.add_argument('--lex', action='store_true',
+                       help='Print the tokens of the card\'s rules text.')
+    group.add_argument('--parse', action='store_true',
+                       help='Parse the card.')
+    shower.set_defaults(func=show_card)
 
     args = parser.parse_args()
+    logs.setup_from_args(args)
+    if args.lean_lexing:
+        _set_lexing('lean')
     args.func(args)
 
 if __name__ == '__main__':
@@ -73,16 +73,24 @@ tokens {
 
 @lexer::header {
     import logging
-    logging.basicConfig(level=logging.DEBUG, filename="LOG")
     llog = logging.getLogger("Lexer")
-    llog.setLevel(logging.DEBUG)
+
+    # The rule stack is only needed for parser errors, so when built with
+    # -trace, make the lexer's trace calls do nothing.
+    if not hasattr(Lexer, 'LEXER_TRACE_REDEF'):
+        Lexer.LEXER_TRACE_REDEF = True
+        def _lexerTrace(self, ruleName, ruleIndex):
+            pass
+
+        Lexer.traceIn = _lexerTrace
+        Lexer.traceOut = _lexerTrace
 }
 
 @parser::header {
     import logging
-    logging.basicConfig(level=logging.DEBUG, filename="LOG")
+    # Not imported by the generated parser unless it builds trees.
+    from antlr3.tree import CommonTree
     plog = logging.getLogger("Parser")
-    plog.setLevel(logging.DEBUG)
 
     # hack to make all subparsers have the same error logging
     # header guard to prevent rewrapping some functions below
@@ -95,7 +103,7 @@ tokens {
             return getattr(self._state, 'card', None)
 
         def _emitDebugMessage(self, msg):
-            plog.debug("{}:{}".format(self.getCardState(), msg))
+            plog.debug("%s:%s", self.getCardState(), msg)
 
         def _getErrorHeader(self, e):
             if hasattr(self._state, 'card'):
@@ -121,6 +129,37 @@ tokens {
         def _getTokenErrorDisplay(self, t):
             return str(t)
 
+        # In fail-fast mode (when the shared state has failFast set), the
+        # first syntax error stops the parse by raising a SyntaxStop, which
+        # holds the offending token and the rule stack, instead of being
+        # reported and recovered from.
+        class SyntaxStop(Exception):
+            def __init__(self, token, stack):
+                super().__init__(token, stack)
+                self.token = token
+                self.stack = stack
+
+        def __reportError(supermethod):
+            def _reportError(self, e):
+                if getattr(self._state, 'failFast', False):
+                    raise Parser.SyntaxStop(getattr(e, 'token', None),
+                                            self.getRuleInvocationStack())
+                supermethod(self, e)
+            return _reportError
+
+        # When the parser is generated with -trace, every rule calls
+        # traceIn on entry and traceOut on exit, which we use to keep the
+        # rule invocation stack in the shared state as we go. This is much
+        # cheaper than walking the interpreter stack on every error.
+        def _traceIn(self, ruleName, ruleIndex):
+            try:
+                self._state.ruleStack.append(ruleName)
+            except AttributeError:
+                self._state.ruleStack = [ruleName]
+
+        def _traceOut(self, ruleName, ruleIndex):
+            self._state.ruleStack.pop()
+
         def _getRuleInvocationStack(cls, ffilter):
             rules = []
             mrules = []
@@ -147,7 +186,15 @@ tokens {
 
         def __getRuleInvocationStack(ffilter):
             def _getRuleInvocationStack1(self):
-                return self._getRuleInvocationStack(ffilter)
+                stack = getattr(self._state, 'ruleStack', None)
+                if stack is None or not Parser.FAST_RULE_STACK:
+                    return self._getRuleInvocationStack(ffilter)
+                # Like the frame walk, collapse directly recursive calls.
+                rules = []
+                for r in stack:
+                    if not rules or rules[-1] != r:
+                        rules.append(r)
+                return rules
             return _getRuleInvocationStack1
 
         Parser.emitErrorMessage = log_error
@@ -156,7 +203,12 @@ tokens {
         Parser.getErrorHeader = _getErrorHeader
         Parser.getErrorMessage = __getErrorMessage(Parser.getErrorMessage)
         Parser.getTokenErrorDisplay = _getTokenErrorDisplay
+        Parser.SyntaxStop = SyntaxStop
+        Parser.reportError = __reportError(Parser.reportError)
         Parser._getRuleInvocationStack = classmethod(_getRuleInvocationStack)
+        Parser.FAST_RULE_STACK = True
+        Parser.traceIn = _traceIn
+        Parser.traceOut = _traceOut
         Parser.getRuleInvocationStack = __getRuleInvocationStack(_ffilter)
 
     # hack to make __repr__ somewhat meaningful
@@ -0,0 +1,351 @@
+# This file is part of Demystify.
+# 
+# Demystify: a Magic: The Gathering parser
+# Copyright (C) 2012 Benjamin S Wolf
+# 
+# Demystify is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 3 of the License,
+# or (at your option) any later version.
+# 
+# Demystify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with Demystify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""index -- Indexes over card data for fast searching."""
+
+import array
+import collections
+import logging
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+ilog = logging.getLogger('Index')
+ilog.setLevel(logging.INFO)
+
+## Trigram index over rules text ##
+
+def _trigrams(s):
+    return {s[i:i+3] for i in range(len(s) - 2)}
+
+def _literals(parsed):
+    """ Given a parsed regular expression (or part of one), returns a list
+        of requirements that every match must satisfy, all of which must
+        hold. Each requirement is either a string that appears in the match,
+        or a tuple ('or', [requirements...]) of alternatives, each of which
+        is itself a list of requirements. Strings shorter than a trigram
+        aren't included. """
+    reqs = []
+    run = []
+    def flush():
+        # Lines are indexed separately, so no trigram spans a newline.
+        for part in ''.join(run).split('\n'):
+            if len(part) >= 3:
+                reqs.append(part)
+        del run[:]
+    for op, av in parsed:
+        if op is sre_parse.LITERAL:
+            run.append(chr(av))
+            continue
+        if op is sre_parse.AT:
+            # Anchors and word boundaries take up no space.
+            continue
+        flush()
+        if op is sre_parse.SUBPATTERN:
+            reqs.extend(_literals(av[-1]))
+        elif op is sre_parse.BRANCH:
+            alts = [_literals(a) for a in av[1]]
+            # If any alternative has no requirements, neither does the branch.
+            if all(alts):
+                reqs.append(('or', alts))
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT,
+                    getattr(sre_parse, 'POSSESSIVE_REPEAT', None)):
+            lo, hi, p = av
+            if lo >= 1:
+                reqs.extend(_literals(p))
+        elif op is getattr(sre_parse, 'ATOMIC_GROUP', None):
+            reqs.extend(_literals(av))
+        # Anything else (character classes, lookarounds, backreferences...)
+        # could match many things, so we don't require anything of it.
+    flush()
+    return reqs
+
+class TrigramIndex(object):
+    """ An inverted index from each trigram (three consecutive characters)
+        of the rules text of every card to the lines it appears in.
+
+        To search with a regular expression, we find the literal strings any
+        match must contain, look up the lines containing all of their
+        trigrams, and only run the regular expression on those lines.
+        The index is case-insensitive (it stores casefolded text), which
+        at worst gives us extra lines to check. """
+
+    def __init__(self):
+        # line id -> (card name, line), or None if the card was removed
+        self._lines = []
+        # trigram -> array of line ids, in increasing order
+        self._postings = {}
+        # card name -> line ids
+        self._by_card = {}
+
+    def __len__(self):
+        return len(self._by_card)
+
+    def add_card(self, name, rules):
+        """ Adds a card's rules text to the index, replacing any text
+            previously added for that card. """
+        self.remove_card(name)
+        ids = []
+        for line in rules.split('\n'):
+            lid = len(self._lines)
+            self._lines.append((name, line))
+            ids.append(lid)
+            for t in _trigrams(line.casefold()):
+                p = self._postings.get(t)
+                if p is None:
+                    p = self._postings[t] = array.array('I')
+                p.append(lid)
+        self._by_card[name] = ids
+
+    def remove_card(self, name):
+        """ Removes a card's text from the index. Its entries are left in
+            the trigram lists, but are ignored. """
+        for lid in self._by_card.pop(name, ()):
+            self._lines[lid] = None
+
+    def _lookup(self, s):
+        """ Returns the set of line ids containing every trigram in s. """
+        postings = []
+        for t in _trigrams(s.casefold()):
+            p = self._postings.get(t)
+            if p is None:
+                return set()
+            postings.append(p)
+        postings.sort(key=len)
+        result = set(postings[0])
+        for p in postings[1:]:
+            result.intersection_update(p)
+            if not result:
+                break
+        return result
+
+    def _evaluate(self, reqs, key):
+        """ Returns the set of key(line id) for lines that satisfy all of
+            reqs (as returned by _literals), or None if reqs is empty. """
+        result = None
+        for r in reqs:
+            if isinstance(r, str):
+                s = {key(lid) for lid in self._lookup(r)}
+            else:
+                s = set()
+                for alt in r[1]:
+                    s |= self._evaluate(alt, key)
+            result = s if result is None else result & s
+            if not result:
+                return set()
+        return result
+
+    def _requirements(self, regex):
+        try:
+            return _literals(sre_parse.parse(regex.pattern, regex.flags))
+        except Exception as e:
+            ilog.warning("Unable to analyze {!r}: {}"
+                         .format(regex.pattern, e))
+            return []
+
+    def search(self, regex):
+        """ Returns a list of (card name, line) for every line in the index
+            that regex (a compiled regular expression) finds a match in. """
+        reqs = self._requirements(regex)
+        if reqs:
+            lids = sorted(self._evaluate(reqs, lambda lid: lid))
+            lines = (self._lines[lid] for lid in lids)
+        else:
+            lines = iter(self._lines)
+        return [nl for nl in lines if nl and regex.search(nl[1])]
+
+    def candidate_cards(self, regex):
+        """ Returns the set of names of cards whose rules text might contain
+            a match for regex, or None if every card might.
+            A match spanning more than one line is still found, as long as
+            each literal string it requires is on one line. """
+        reqs = self._requirements(regex)
+        if not reqs:
+            return None
+        lines = self._lines
+        names = self._evaluate(reqs,
+                               lambda lid: lines[lid] and lines[lid][0])
+        names.discard(None)
+        return names
+
+## Card name recognition ##
+
+class NameMatcher(object):
+    """ An Aho-Corasick automaton over a set of names, which finds every
+        occurrence of every name in a string in a single pass. """
+
+    def __init__(self, names):
+        goto = [{}]
+        out = [()]
+        for name in names:
+            s = 0
+            for ch in name:
+                t = goto[s].get(ch)
+                if t is None:
+                    t = len(goto)
+                    goto[s][ch] = t
+                    goto.append({})
+                    out.append(())
+                s = t
+            out[s] = (name,)
+        # Breadth-first, so each state's failure state is done before it.
+        fail = [0] * len(goto)
+        queue = collections.deque(goto[0].values())
+        while queue:
+            s = queue.popleft()
+            for ch, t in goto[s].items():
+                queue.append(t)
+                f = fail[s]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                f = goto[f].get(ch, 0)
+                fail[t] = f if f != t else 0
+                if out[fail[t]]:
+                    out[t] = out[t] + out[fail[t]]
+        self._goto = goto
+        self._fail = fail
+        self._out = out
+        self._names = frozenset(names)
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def __len__(self):
+        return len(self._names)
+
+    def find(self, text):
+        """ Returns a dict mapping each name found in text to the list of
+            positions where it starts, in increasing order. Occurrences may
+            overlap. """
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        found = {}
+        s = 0
+        for i, ch in enumerate(text):
+            while s and ch not in goto[s]:
+                s = fail[s]
+            s = goto[s].get(ch, 0)
+            for name in out[s]:
+                found.setdefault(name, []).append(i + 1 - len(name))
+        return found
+
+class NameTrie(object):
+    """ A trie over the words of a set of names, which tells whether a run
+        of words is one of the names without joining them into a string.
+        A name's words are its space-separated parts, as from split(' '). """
+
+    def __init__(self, names=()):
+        self._root = {}
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        node = self._root
+        for w in name.split(' '):
+            node = node.setdefault(w, {})
+        node[None] = True
+
+    def discard(self, name):
+        """ Removes name, if present. """
+        node = self._root
+        for w in name.split(' '):
+            node = node.get(w)
+            if node is None:
+                return
+        node.pop(None, None)
+
+    def walk(self, words, start):
+        """ Returns the list of nodes reached after each prefix of
+            words[start:], beginning with the empty prefix and ending at
+            the longest one that some name begins with. """
+        node = self._root
+        path = [node]
+        for w in words[start:]:
+            node = node.get(w)
+            if node is None:
+                break
+            path.append(node)
+        return path
+
+    @staticmethod
+    def ends(path, n, last):
+        """ Given the path from walk() for some words, returns whether the
+            first n of those words followed by the word last is a name. """
+        if n >= len(path):
+            return False
+        child = path[n].get(last)
+        return child is not None and None in child
+
+def _to_bits(ids):
+    """ Returns the int whose set bits are the given ids. """
+    b = bytearray(max(ids) // 8 + 1)
+    for i in ids:
+        b[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(b, 'little')
+
+def bit_ids(bits):
+    """ Yields the positions of the set bits of bits, in increasing order. """
+    s = bin(bits)[:1:-1]
+    i = s.find('1')
+    while i >= 0:
+        yield i
+        i = s.find('1', i + 1)
+
+class BitsetIndex(object):
+    """ Maps keys to sets of small integer ids, each stored as an int with
+        those bits set, so that sets can be combined with &, | and &~.
+
+        Ids added for a key are collected in a list, and only turned into
+        bits when that key is next looked up, so building the index is
+        linear in the number of ids added. """
+
+    def __init__(self):
+        self._pending = {}
+        self._bits = {}
+
+    def add(self, i, keys):
+        """ Adds id i to the set for each of keys. """
+        for key in keys:
+            self._pending.setdefault(key, []).append(i)
+
+    def remove(self, i, keys):
+        """ Removes id i from the set for each of keys. """
+        mask = ~(1 << i)
+        for key in keys:
+            self._bits[key] = self.get(key) & mask
+
+    def get(self, key):
+        """ Returns the bits of the ids for key (0 if there are none). """
+        pending = self._pending.pop(key, None)
+        if pending:
+            bits = self._bits.get(key, 0) | _to_bits(pending)
+            self._bits[key] = bits
+            return bits
+        return self._bits.get(key, 0)
+
+    def compact(self):
+        """ Turns every key's pending ids into bits. """
+        for key in list(self._pending):
+            self.get(key)
+
+    def keys(self):
+        """ Returns the set of keys that have had ids added. """
+        return set(self._bits) | set(self._pending)
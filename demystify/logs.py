@@ -0,0 +1,196 @@
+# This file is part of Demystify.
+# 
+# Demystify: a Magic: The Gathering parser
+# Copyright (C) 2012 Benjamin S Wolf
+# 
+# Demystify is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 3 of the License,
+# or (at your option) any later version.
+# 
+# Demystify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with Demystify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""logs -- Logging setup for Demystify and its worker processes."""
+
+import atexit
+import contextlib
+import gzip
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import multiprocessing.util
+import os
+import shutil
+
+LOGFILE = "LOG"
+
+class JsonFormatter(logging.Formatter):
+    """ Formats each record as a single line of JSON. """
+    def format(self, record):
+        d = {'time': record.created,
+             'level': record.levelname,
+             'logger': record.name,
+             'process': record.process,
+             'message': record.getMessage()}
+        if record.exc_info:
+            d['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            d['exc'] = record.exc_text
+        return json.dumps(d, ensure_ascii=False)
+
+class RotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """ A RotatingFileHandler that rotates once the file has passed maxBytes,
+        rather than formatting every record an extra time to see whether
+        it would. """
+    def shouldRollover(self, record):
+        if self.stream is None:
+            self.stream = self._open()
+        return self.maxBytes > 0 and self.stream.tell() >= self.maxBytes
+
+class RecordList(logging.Handler):
+    """ Keeps every record logged to it, in order. """
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+@contextlib.contextmanager
+def capture(*names):
+    """ Collects the records logged to the named loggers in the body, into
+        the list it gives. The records are still logged as usual. """
+    handler = RecordList()
+    loggers = [logging.getLogger(name) for name in names]
+    for logger in loggers:
+        logger.addHandler(handler)
+    try:
+        yield handler.records
+    finally:
+        for logger in loggers:
+            logger.removeHandler(handler)
+
+def _gzip_namer(name):
+    return name + '.gz'
+
+def _gzip_rotator(source, dest):
+    with open(source, 'rb') as f, gzip.open(dest, 'wb') as g:
+        shutil.copyfileobj(f, g)
+    os.remove(source)
+
+_queue = None
+_listener = None
+
+def setup(filename=LOGFILE, level=logging.INFO, json_format=False,
+          max_bytes=64 * 1024 * 1024, backups=5, buffer_size=1024):
+    """ Writes all log records, from this process and any processes forked
+        from it afterward, or given worker_config() (such as card.map_multi
+        workers), to filename. Those processes send their records through a
+        queue to a thread in this process, so that only this process writes
+        to the file.
+
+        Writes are buffered, buffer_size records at a time, except that
+        errors are written immediately. The log file is rotated when it
+        reaches max_bytes and at the start of each run, keeping at most
+        backups old logs, compressed with gzip.
+        If json_format is True, each record is written as a line of JSON.
+
+        The root logger is set to level, so that loggers which don't set
+        their own level skip formatting messages below it. """
+    global _queue, _listener
+    if _listener:
+        shutdown()
+    handler = RotatingFileHandler(
+        filename, maxBytes=max_bytes, backupCount=backups, delay=True,
+        encoding='utf-8')
+    handler.namer = _gzip_namer
+    handler.rotator = _gzip_rotator
+    if os.path.exists(filename) and os.path.getsize(filename):
+        handler.doRollover()
+    if json_format:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(
+            fmt='%(levelname)s:%(name)s:%(message)s'))
+    buffered = logging.handlers.MemoryHandler(
+        buffer_size, flushLevel=logging.ERROR, target=handler)
+
+    # Made for a forkserver context, so that it can be given to processes
+    # started by a card pool's server as well as to forked ones.
+    _queue = multiprocessing.get_context('forkserver').Queue()
+    _listener = logging.handlers.QueueListener(_queue, buffered)
+    _listener.start()
+    root = logging.getLogger()
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+    root.addHandler(buffered)
+    root.setLevel(level)
+
+def _log_through(queue):
+    """ Only log through queue: drop the file handler and any others (eg.
+        console output) this process has. """
+    for logger in [logging.getLogger()] + [
+            l for l in logging.Logger.manager.loggerDict.values()
+            if isinstance(l, logging.Logger)]:
+        for h in logger.handlers[:]:
+            logger.removeHandler(h)
+    logging.getLogger().addHandler(logging.handlers.QueueHandler(queue))
+
+def _after_fork(arg):
+    """ In forked processes, only log through the queue. """
+    if _queue is not None:
+        _log_through(_queue)
+
+multiprocessing.util.register_after_fork(_after_fork, _after_fork)
+
+def worker_config():
+    """ Returns what a process that isn't forked from this one needs to log
+        as if it were (see worker_setup): the queue, or None if setup hasn't
+        been called, and the root logger's level. The queue can only be
+        pickled as an argument to a new multiprocessing Process. """
+    return _queue, logging.getLogger().level
+
+def worker_setup(config):
+    """ In a process given config by worker_config, logs through the
+        parent's queue at its level. """
+    queue, level = config
+    logging.getLogger().setLevel(level)
+    if queue is not None:
+        _log_through(queue)
+
+def shutdown():
+    """ Writes out all buffered records and stops the writer thread. """
+    global _queue, _listener
+    if _listener:
+        _listener.stop()
+        for h in _listener.handlers:
+            logging.getLogger().removeHandler(h)
+            h.close()
+        _listener = None
+        _queue = None
+
+# Modules whose atexit handlers may still log (eg. card, which stops its
+# workers at exit) import this module first, so that this runs after them.
+atexit.register(shutdown)
+
+def add_arguments(parser):
+    """ Adds logging options to the main parser. """
+    parser.add_argument('--log-level', default='INFO',
+        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+        help=('Lowest level of messages to write to the log. Messages '
+              'below this level are not even formatted. Defaults to INFO; '
+              'DEBUG adds the text and result tree of every failed parse.'))
+    parser.add_argument('--log-file', default=LOGFILE,
+        help='File to write the log to. Defaults to LOG.')
+    parser.add_argument('--log-json', action='store_true',
+        help='Write the log as one JSON object per line.')
+
+def setup_from_args(args):
+    setup(args.log_file, getattr(logging, args.log_level), args.log_json)
@@ -0,0 +1,146 @@
+# This file is part of Demystify.
+# 
+# Demystify: a Magic: The Gathering parser
+# Copyright (C) 2012 Benjamin S Wolf
+# 
+# Demystify is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 3 of the License,
+# or (at your option) any later version.
+# 
+# Demystify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with Demystify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""memo -- A cache of parse results, shared between processes."""
+
+import collections
+import glob
+import logging
+import os
+import pickle
+import sqlite3
+
+import data
+
+mlog = logging.getLogger('Memo')
+mlog.setLevel(logging.INFO)
+
+GRAMMARDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'grammar')
+
+# tree: the result tree, as a string
+# errors: the number of syntax errors encountered
+# case: the text of the first error case found, if any
+# messages: what the lexer and parser logged, as tuples
+#     (logger name, level, whether the card name was cut from the front,
+#      message), to be logged again whenever the result is reused
+ParseResult = collections.namedtuple('ParseResult',
+                                     'tree errors case messages')
+
+# Changed whenever ParseResult does, so that results saved in an older
+# format aren't read.
+FORMAT = 2
+
+def grammar_hash():
+    """ Returns a hash of the generated lexer and parser modules, so that
+        results are only reused with the grammar build that produced them. """
+    return data.content_hash(
+        *sorted(glob.glob(os.path.join(GRAMMARDIR, 'Demystify*.py'))))
+
+def lexer_hash():
+    """ Returns a hash of the generated lexer modules alone, for anything
+        that depends only on how text is lexed. """
+    return data.content_hash(
+        *sorted(glob.glob(os.path.join(GRAMMARDIR, 'DemystifyLexer*.py'))))
+
+class ParseMemo(object):
+    """ Maps (rule name, text) to the ParseResult of parsing that text with
+        that rule, for one build of the grammar.
+
+        Results are kept in an in-memory LRU cache in front of an sqlite
+        database, which any number of processes may read and add to
+        at the same time. Each process keeps its own hit and miss counts. """
+
+    def __init__(self, path, build, size=100000):
+        self.path = path
+        self.build = '{}:{}'.format(build, FORMAT)
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._lru = collections.OrderedDict()
+        self._db = None
+        self._pid = None
+
+    def __getstate__(self):
+        # Sent to the card workers, which open their own connection and
+        # keep their own cache and counts.
+        return {'path': self.path, 'build': self.build, 'size': self.size}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.hits = 0
+        self.misses = 0
+        self._lru = collections.OrderedDict()
+        self._db = None
+        self._pid = None
+
+    def _conn(self):
+        # sqlite connections can't be shared across a fork.
+        if self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._db = sqlite3.connect(self.path, timeout=60,
+                                       isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS parses '
+                             '(build TEXT, rule TEXT, text TEXT, result BLOB, '
+                             'PRIMARY KEY (build, rule, text))')
+            self._pid = os.getpid()
+        return self._db
+
+    def _remember(self, key, result):
+        self._lru[key] = result
+        if len(self._lru) > self.size:
+            self._lru.popitem(last=False)
+
+    def get(self, rule, text):
+        """ Returns the saved ParseResult, or None if there isn't one. """
+        key = (rule, text)
+        if key in self._lru:
+            self._lru.move_to_end(key)
+            self.hits += 1
+            return self._lru[key]
+        try:
+            row = self._conn().execute(
+                'SELECT result FROM parses '
+                'WHERE build = ? AND rule = ? AND text = ?',
+                (self.build, rule, text)).fetchone()
+        except sqlite3.Error as e:
+            mlog.warning('Unable to read from parse memo: {}'.format(e))
+            row = None
+        if row:
+            result = ParseResult(*pickle.loads(row[0]))
+            self._remember(key, result)
+            self.hits += 1
+            return result
+        self.misses += 1
+        return None
+
+    def put(self, rule, text, result):
+        """ Saves a ParseResult for the given rule and text. """
+        self._remember((rule, text), result)
+        try:
+            self._conn().execute(
+                'INSERT OR IGNORE INTO parses VALUES (?, ?, ?, ?)',
+                (self.build, rule, text, pickle.dumps(tuple(result))))
+        except sqlite3.Error as e:
+            mlog.warning('Unable to write to parse memo: {}'.format(e))
+
+    def stats(self):
+        """ Returns the pair (hits, misses) for this process. """
+        return self.hits, self.misses
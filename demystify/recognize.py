@@ -0,0 +1,276 @@
+# This file is part of Demystify.
+#
+# Demystify: a Magic: The Gathering parser
+# Copyright (C) 2012 Benjamin S Wolf
+#
+# Demystify is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 3 of the License,
+# or (at your option) any later version.
+#
+# Demystify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Demystify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""recognize -- A recognition-only build of the grammar.
+
+If run as a script, writes a copy of the grammar to grammar/recognizer/ with
+the AST output option, tree operators, rewrite rules, labels and parser
+actions taken out. The parser built from it accepts and rejects the same
+text as the full parser, but builds no trees. The header, members and
+lexer rules are kept as they are.
+
+The copy's grammars are renamed (Demystify to DemystifyRecognizer, and each
+imported parser grammar g to r_g) so that the modules generated from it
+can't be mistaken for those of the full build. Build it like the full
+grammar:
+    $ cd demystify/grammar/recognizer/
+    $ antlr3 -trace DemystifyRecognizer.g
+"""
+
+import os
+import re
+
+GRAMMARDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'grammar')
+OUTDIR = os.path.join(GRAMMARDIR, 'recognizer')
+
+MAIN = 'Demystify'
+RECOGNIZER = 'DemystifyRecognizer'
+
+_ident = re.compile(r'[A-Za-z_]\w*')
+_label = re.compile(r'\s*\+?=(?!>)')
+_header = re.compile(r'^(lexer |parser )?grammar (\w+);', re.M)
+_imports = re.compile(r'^import ([^;]*);', re.M)
+_output = re.compile(r'\s*output\s*=\s*AST\s*;')
+
+def _skip_string(text, i, quote):
+    """ Returns the index just past the string literal starting at i. """
+    i += 1
+    while text[i] != quote:
+        i += 2 if text[i] == '\\' else 1
+    return i + 1
+
+def _skip_comment(text, i):
+    """ Returns the index just past the comment starting at i, or i if
+        there isn't one there. """
+    if text.startswith('//', i):
+        end = text.find('\n', i)
+        return len(text) if end < 0 else end
+    if text.startswith('/*', i):
+        return text.index('*/', i) + 2
+    return i
+
+def _skip_braces(text, i):
+    """ Returns the index just past the action (or block) starting with the
+        brace at i. Actions are Python, so strings and comments in them are
+        skipped over. """
+    depth = 0
+    while True:
+        c = text[i]
+        if c in '\'"':
+            i = _skip_string(text, i, c)
+            continue
+        if c == '#':
+            i = text.find('\n', i)
+            continue
+        if c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+
+def _skip_rewrite(text, i):
+    """ Returns the index of the end of the rewrite starting at i: the | or
+        ; that ends the alternative, or the ) that ends its block. """
+    depth = 0
+    while True:
+        j = _skip_comment(text, i)
+        if j != i:
+            i = j
+            continue
+        c = text[i]
+        if c == "'":
+            i = _skip_string(text, i, c)
+            continue
+        if c == '{':
+            i = _skip_braces(text, i)
+            continue
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            if depth == 0:
+                return i
+            depth -= 1
+        elif c in '|;' and depth == 0:
+            return i
+        i += 1
+
+def _strip_rule(text, i):
+    """ Given the index just past the colon of a parser rule, returns the
+        rule body with everything but recognition taken out, and the index
+        just past its semicolon. """
+    out = []
+    depth = 0
+    keep_block = False
+    while True:
+        j = _skip_comment(text, i)
+        if j != i:
+            out.append(text[i:j])
+            i = j
+            continue
+        c = text[i]
+        if c == "'":
+            j = _skip_string(text, i, c)
+            out.append(text[i:j])
+            i = j
+            continue
+        if c == '{':
+            j = _skip_braces(text, i)
+            # Keep options blocks and semantic predicates.
+            if keep_block or text.startswith('?', j):
+                out.append(text[i:j])
+            keep_block = False
+            i = j
+            continue
+        if text.startswith('->', i):
+            i = _skip_rewrite(text, i + 2)
+            continue
+        m = _ident.match(text, i)
+        if m:
+            keep_block = m.group(0) == 'options'
+            lm = _label.match(text, m.end())
+            if lm and not keep_block:
+                # A label, which only actions and rewrites would use.
+                i = lm.end()
+            else:
+                out.append(m.group(0))
+                i = m.end()
+            continue
+        i += 1
+        if c in '^!':
+            continue
+        out.append(c)
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == ';' and depth == 0:
+            return ''.join(out), i
+
+def _copy_rule(text, i):
+    """ Given the index just past the colon of a lexer rule, returns the
+        rule body as it is, and the index just past its semicolon. """
+    start = i
+    depth = 0
+    while True:
+        j = _skip_comment(text, i)
+        if j != i:
+            i = j
+            continue
+        c = text[i]
+        if c == "'":
+            i = _skip_string(text, i, c)
+            continue
+        if c == '{':
+            i = _skip_braces(text, i)
+            continue
+        i += 1
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == ';' and depth == 0:
+            return text[start:i], i
+
+def strip_grammar(text):
+    """ Returns the text of a grammar with the parts that only build trees
+        (see the module docstring) taken out of its parser rules. """
+    out = []
+    i = 0
+    n = len(text)
+    while i < n:
+        j = _skip_comment(text, i)
+        if j != i:
+            out.append(text[i:j])
+            i = j
+            continue
+        c = text[i]
+        if c == "'":
+            j = _skip_string(text, i, c)
+            out.append(text[i:j])
+            i = j
+            continue
+        if c == '{':
+            # options, tokens, and named actions such as @header.
+            j = _skip_braces(text, i)
+            out.append(text[i:j])
+            i = j
+            continue
+        m = _ident.match(text, i)
+        if m and (i == 0 or not (text[i - 1].isalnum() or text[i - 1] in '_@:')):
+            name = m.group(0)
+            k = m.end()
+            while k < n and text[k] in ' \t\n':
+                k += 1
+            if text.startswith(':', k) and not text.startswith('::', k):
+                out.append(text[i:k + 1])
+                if name[0].islower():
+                    body, i = _strip_rule(text, k + 1)
+                else:
+                    body, i = _copy_rule(text, k + 1)
+                out.append(body)
+                continue
+            out.append(name)
+            i = m.end()
+            continue
+        out.append(c)
+        i += 1
+    return _output.sub('', ''.join(out))
+
+def _rename(name, parsers):
+    if name == MAIN:
+        return RECOGNIZER
+    if name in parsers:
+        return 'r_' + name
+    return name
+
+def write_recognizer():
+    """ Writes the recognition-only copy of the grammar to OUTDIR. """
+    grammars = {}
+    for filename in sorted(os.listdir(GRAMMARDIR)):
+        if filename.endswith('.g'):
+            with open(os.path.join(GRAMMARDIR, filename)) as f:
+                grammars[filename[:-2]] = f.read()
+    parsers = {name for name, text in grammars.items()
+               if _header.search(text).group(1) == 'parser '}
+    def rename_import(m):
+        names = [s.strip() for s in m.group(1).split(',')]
+        return 'import {};'.format(', '.join(_rename(s, parsers)
+                                             for s in names))
+    os.makedirs(OUTDIR, exist_ok=True)
+    for name, text in sorted(grammars.items()):
+        if name != MAIN and name not in parsers:
+            # Lexer grammars are used as they are.
+            new = text
+        else:
+            new = strip_grammar(text)
+        new = _header.sub(lambda m: '{}grammar {};'.format(
+                              m.group(1) or '', _rename(m.group(2), parsers)),
+                          new, count=1)
+        new = _imports.sub(rename_import, new)
+        filename = os.path.join(OUTDIR, _rename(name, parsers) + '.g')
+        with open(filename, 'w') as f:
+            f.write(new)
+    with open(os.path.join(OUTDIR, '__init__.py'), 'w'):
+        pass
+    print('Wrote the recognition-only grammar to {}.'.format(OUTDIR))
+
+if __name__ == "__main__":
+    write_recognizer()
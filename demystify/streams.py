@@ -0,0 +1,407 @@
+# This file is part of Demystify.
+# 
+# Demystify: a Magic: The Gathering parser
+# Copyright (C) 2012 Benjamin S Wolf
+# 
+# Demystify is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 3 of the License,
+# or (at your option) any later version.
+# 
+# Demystify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with Demystify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""streams -- Character and token streams for the lexer and parser."""
+
+import array
+import functools
+import sys
+
+import antlr3
+
+import data
+
+## Character streams ##
+
+_utf32 = 'utf-32-le' if sys.byteorder == 'little' else 'utf-32-be'
+
+def code_points(text):
+    """ Returns an array of the code points of text. """
+    codes = array.array('I')
+    codes.frombytes(text.encode(_utf32))
+    return codes
+
+class TextStream(antlr3.ANTLRStringStream):
+    """ A character stream over text[start:stop], for the lexer.
+
+        ANTLRStringStream makes a list of the code point of every character
+        before lexing starts. This reads from codes, an array of the code
+        points of all of text (see code_points), which can be shared by
+        streams over different parts of the same text. Positions are
+        relative to start, as if text[start:stop] were the whole text,
+        except that lines are counted from line (eg. the line of text that
+        start is on), so that errors are reported at the right line. """
+
+    def __init__(self, text, start=0, stop=None, codes=None, line=1):
+        # ANTLRStringStream.__init__ would make the list, so we skip it.
+        self.strdata = text
+        self._codes = code_points(text) if codes is None else codes
+        self._base = start
+        self._stop = len(text) if stop is None else stop
+        self._line = line
+        self.n = self._stop - start
+        self.name = None
+        self.reset()
+
+    @property
+    def p(self):
+        return self._i - self._base
+
+    def reset(self):
+        # _i is the index into text (and codes) of the next character.
+        self._i = self._base
+        self.line = self._line
+        self.charPositionInLine = 0
+        self._markers = []
+        self.lastMarker = None
+        self.markDepth = 0
+
+    def consume(self):
+        i = self._i
+        if i < self._stop:
+            if self._codes[i] == 10:
+                self.line += 1
+                self.charPositionInLine = 0
+            else:
+                self.charPositionInLine += 1
+            self._i = i + 1
+
+    def LA(self, i):
+        if i > 0:
+            k = self._i + i - 1
+            if k < self._stop:
+                return self._codes[k]
+            return antlr3.EOF
+        if i == 0:
+            return 0
+        k = self._i + i
+        if k >= self._base:
+            return self._codes[k]
+        return antlr3.EOF
+
+    def LT(self, i):
+        c = self.LA(i)
+        return c if c <= 0 else chr(c)
+
+    def index(self):
+        return self._i - self._base
+
+    def size(self):
+        return self.n
+
+    def mark(self):
+        state = (self._i, self.line, self.charPositionInLine)
+        if self.markDepth < len(self._markers):
+            self._markers[self.markDepth] = state
+        else:
+            self._markers.append(state)
+        self.markDepth += 1
+        self.lastMarker = self.markDepth
+        return self.lastMarker
+
+    def rewind(self, marker=None):
+        if marker is None:
+            marker = self.lastMarker
+        i, line, charPositionInLine = self._markers[marker - 1]
+        self._i = i
+        self.line = line
+        self.charPositionInLine = charPositionInLine
+        self.release(marker)
+
+    def release(self, marker=None):
+        if marker is None:
+            marker = self.lastMarker
+        self.markDepth = marker - 1
+
+    def seek(self, index):
+        """ Moves to index. Moving forward consumes characters, so that the
+            line and position are kept up to date. """
+        i = self._base + index
+        if i <= self._i:
+            self._i = i
+            return
+        while self._i < i and self._i < self._stop:
+            self.consume()
+
+    def substring(self, start, stop):
+        return self.strdata[self._base + start:self._base + stop + 1]
+
+    def getLine(self):
+        return self.line
+
+    def getCharPositionInLine(self):
+        return self.charPositionInLine
+
+    def setLine(self, line):
+        self.line = line
+
+    def setCharPositionInLine(self, pos):
+        self.charPositionInLine = pos
+
+    def getSourceName(self):
+        return self.name
+
+## Lean tokens ##
+
+class LeanToken(antlr3.Token):
+    """ A token for the parser, with slots for its fields rather than the
+        private attributes and properties of CommonToken. (It must still be
+        a Token for the tree classes to accept it.) Its text is always set,
+        and interned by the lexer (see LeanLexerMixin), so that tokens of
+        the same word share it. """
+
+    __slots__ = ('type', 'channel', 'text', 'start', 'stop', 'line',
+                 'charPositionInLine', 'index', 'input')
+
+    # Token type -> name, eg. the parser's tokenNames, for typeName.
+    names = ()
+
+    def __init__(self, type, channel=antlr3.DEFAULT_CHANNEL, text=None,
+                 input=None, start=None, stop=None):
+        # Token.__init__ would only set the attributes we replace.
+        self.type = type
+        self.channel = channel
+        self.text = text
+        self.input = input
+        self.start = start
+        self.stop = stop
+        self.line = 0
+        self.charPositionInLine = -1
+        self.index = -1
+
+    @property
+    def typeName(self):
+        if 0 <= self.type < len(self.names):
+            return self.names[self.type]
+        return str(self.type)
+
+    def __str__(self):
+        channel = ',channel={}'.format(self.channel) if self.channel else ''
+        return ('[@{0.index},{0.start}:{0.stop}={0.text!r},<{0.typeName}>'
+                '{1},{0.line}:{0.charPositionInLine}]'.format(self, channel))
+
+class LeanLexerMixin(object):
+    """ Mixed into a lexer, makes it drop the text that its rules put on
+        the hidden channel (ie. whitespace) without making tokens of it,
+        and emit LeanTokens for the rest. The parser never sees hidden
+        tokens, so it matches the same tokens either way, but they have
+        fewer indexes, which shows in error messages. Read the tokens
+        through a LeanTokenStream so that the text of error nodes keeps
+        its whitespace. """
+
+    def mTokens(self):
+        super().mTokens()
+        if (self._state.token is None
+            and self._state.channel == antlr3.HIDDEN_CHANNEL):
+            self.skip()
+
+    def emit(self, token=None):
+        if token is None:
+            start = self._state.tokenStartCharIndex
+            stop = self.getCharIndex() - 1
+            text = self._state.text
+            if text is None:
+                text = self.input.substring(start, stop)
+            token = LeanToken(self._state.type, self._state.channel,
+                              sys.intern(text), self.input, start, stop)
+            token.line = self._state.tokenStartLine
+            token.charPositionInLine = \
+                self._state.tokenStartCharPositionInLine
+        self._state.token = token
+        return token
+
+@functools.lru_cache()
+def lean_lexer(lexer_class):
+    """ Returns the lean version of a lexer class (see LeanLexerMixin). """
+    return type('Lean' + lexer_class.__name__,
+                (LeanLexerMixin, lexer_class), {})
+
+class LeanTokenStream(antlr3.CommonTokenStream):
+    """ A CommonTokenStream for tokens with no whitespace tokens between
+        them, such as a lean lexer's, whose positions are in text.
+
+        The tree classes take the text of an error node (eg. the resync text
+        of "<unexpected: ..., resync=...>") from toString, which joins the
+        text of the tokens in a range, hidden or not. This puts back the
+        text between tokens, so that it reads as it does with whitespace
+        tokens. """
+
+    def __init__(self, tokenSource, text):
+        super().__init__(tokenSource)
+        self.text = text
+
+    def toString(self, start=None, stop=None):
+        if self.p == -1:
+            self.fillBuffer()
+        if start is None:
+            start = 0
+        elif not isinstance(start, int):
+            start = start.index
+        if stop is None:
+            stop = len(self.tokens) - 1
+        elif not isinstance(stop, int):
+            stop = stop.index
+        if start < 0 or stop < 0:
+            return None
+        parts = []
+        prev = None
+        for t in self.tokens[start:stop + 1]:
+            if t.type == antlr3.EOF:
+                break
+            if prev is not None and t.start > prev.stop + 1:
+                parts.append(self.text[prev.stop + 1:t.start])
+            parts.append(t.text)
+            prev = t
+        return ''.join(parts)
+
+## Reusing lexers and parsers ##
+
+def reuse(recognizer, input):
+    """ Points a lexer or parser at new input, along with the recognizers
+        of every grammar it imports, and resets their shared state
+        (including error counts, the card name and fail-fast mode) as if
+        it were new. """
+    recognizer.reset()
+    state = recognizer._state
+    for attr in ('card', 'ruleStack', 'failFast'):
+        state.__dict__.pop(attr, None)
+    seen = set()
+    todo = [recognizer]
+    while todo:
+        r = todo.pop()
+        if id(r) in seen:
+            continue
+        seen.add(id(r))
+        r.input = input
+        todo.extend(v for v in vars(r).values()
+                    if isinstance(v, antlr3.BaseRecognizer))
+
+class RecognizerPool(object):
+    """ Keeps one lexer or parser per class and key (eg. parser rule) to be
+        reused, since making one sets up a recognizer for every imported
+        grammar. Each process has its own, as forked copies are separate.
+        Set enabled to False to make a new one every time. """
+
+    def __init__(self):
+        self.enabled = True
+        self._recognizers = {}
+
+    def get(self, cls, input, key=None):
+        """ Returns a recognizer of class cls reading from input. It may be
+            one returned before with the same key, so it should be done
+            with before get is called again with the same cls and key. """
+        if not self.enabled:
+            return cls(input)
+        r = self._recognizers.get((cls, key))
+        if r is None:
+            r = self._recognizers[cls, key] = cls(input)
+        else:
+            reuse(r, input)
+        return r
+
+recognizers = RecognizerPool()
+
+## Lexed lines ##
+
+def pack_tokens(line, tokens):
+    """ Packs the tokens from lexing line into a pair (fields, texts):
+        fields is an array of the type, start, stop and channel of each
+        token in turn, and texts maps the position of each token whose text
+        isn't simply line[start:stop+1] (eg. mana symbols) to its text. """
+    fields = array.array('i')
+    texts = {}
+    for i, t in enumerate(tokens):
+        fields.extend((t.type, t.start, t.stop, t.channel))
+        if t.text != line[t.start:t.stop + 1]:
+            texts[i] = t.text
+    return fields, texts
+
+class TokenList(antlr3.TokenSource):
+    """ A token source that hands out a list of tokens, then EOF. """
+
+    def __init__(self, tokens, name=None):
+        self._tokens = iter(tokens)
+        self._name = name
+
+    def nextToken(self):
+        return next(self._tokens, None) or antlr3.CommonToken(type=antlr3.EOF)
+
+    def getSourceName(self):
+        return self._name
+
+class TokenCorpus(object):
+    """ The tokens of lines of rules text, as lexed by one build of the
+        lexer, so that the parser can be given the tokens of any part of a
+        line without lexing it again. Lines are keyed by their text. """
+
+    def __init__(self, build):
+        self.build = build
+        self._lines = {}
+
+    @classmethod
+    def load(cls, build):
+        """ Returns the corpus saved for the given lexer build, or an empty
+            one if there isn't one. """
+        corpus = cls(build)
+        corpus._lines = data.load_cache('tokens', build) or {}
+        return corpus
+
+    def save(self):
+        data.save_cache('tokens', self.build, self._lines)
+
+    def __contains__(self, line):
+        return line in self._lines
+
+    def __len__(self):
+        return len(self._lines)
+
+    def add(self, line, packed):
+        """ Adds the tokens of line, as packed by pack_tokens. packed may be
+            None (eg. if the lexer reported errors), in which case views of
+            the line are never given. """
+        self._lines[line] = packed
+
+    def view(self, line, start=0, stop=None, name=None):
+        """ Returns a LeanTokenStream of the tokens of line[start:stop],
+            positioned as if that text had been lexed on its own, or None
+            if the line isn't in the corpus or a token crosses either end
+            of the range. """
+        packed = self._lines.get(line)
+        if packed is None:
+            return None
+        fields, texts = packed
+        if stop is None:
+            stop = len(line)
+        tokens = []
+        for i in range(0, len(fields), 4):
+            ttype, tstart, tstop, channel = fields[i:i + 4]
+            if tstop < start:
+                continue
+            if tstart >= stop:
+                break
+            if tstart < start or tstop >= stop:
+                return None
+            text = texts.get(i // 4)
+            if text is None:
+                text = line[tstart:tstop + 1]
+            t = LeanToken(ttype, channel, text, None, tstart - start,
+                          tstop - start)
+            t.line = 1
+            t.charPositionInLine = tstart - start
+            tokens.append(t)
+        return LeanTokenStream(TokenList(tokens, name), line[start:stop])
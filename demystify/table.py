@@ -0,0 +1,199 @@
+# This file is part of Demystify.
+# 
+# Demystify: a Magic: The Gathering parser
+# Copyright (C) 2012 Benjamin S Wolf
+# 
+# Demystify is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 3 of the License,
+# or (at your option) any later version.
+# 
+# Demystify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with Demystify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""table -- Card attributes as columns, for statistics over many cards.
+
+This module requires numpy, which the rest of Demystify does not."""
+
+import re
+
+import numpy
+
+import card
+
+# Rarity codes in the rarity matrix are 1 + the index here; 0 means the
+# card wasn't printed in that set.
+RARITIES = ('C', 'U', 'R', 'M', 'L', 'S')
+_rarity_codes = {r: i + 1 for i, r in enumerate(RARITIES)}
+
+COLOR_BITS = {c: 1 << i for i, c in enumerate(card.colors)}
+
+TYPE_BITS = {t: 1 << i for i, t in enumerate(card.card_types
+                                             + card.supertypes)}
+
+# A generic cost like (2/W) is worth its number, any other symbol in
+# parentheses is worth one, as is any letter other than X, Y or Z.
+_cost_symbol = re.compile(r'\((\d+)/[^)]*\)|\([^)]*\)|\d+|.')
+_number = re.compile(r'-?\d+$')
+
+def mana_value(cost):
+    """ Returns the converted mana cost of a cost such as "2(W/U)U". """
+    total = 0
+    for m in _cost_symbol.finditer(cost or ''):
+        sym = m.group(0)
+        if m.group(1):
+            total += int(m.group(1))
+        elif sym.isdigit():
+            total += int(sym)
+        elif sym not in 'XYZ':
+            total += 1
+    return total
+
+def color_mask(c):
+    """ Returns the COLOR_BITS of a card's colors (see Card.get_colors). """
+    mask = 0
+    for col in c.get_colors():
+        mask |= COLOR_BITS[col]
+    return mask
+
+def type_mask(c):
+    """ Returns the TYPE_BITS of the types and supertypes of a card. """
+    sup, typ, _ = c.get_types()
+    mask = 0
+    for t in sup + typ:
+        mask |= TYPE_BITS[t]
+    return mask
+
+def _value(s):
+    return int(s) if _number.match(s) else numpy.nan
+
+def _pt(c):
+    """ Returns (power, toughness, loyalty), with NaN for any that the card
+        doesn't have or that aren't numbers (eg. "*" or "1+*"). """
+    if not c.pt:
+        return numpy.nan, numpy.nan, numpy.nan
+    if '/' in c.pt:
+        p, t = c.pt.split('/', 1)
+        return _value(p), _value(t), numpy.nan
+    return numpy.nan, numpy.nan, _value(c.pt)
+
+class CardTable(object):
+    """ The attributes of a list of cards (by default, all of them, sorted
+        by name) as numpy arrays, where row i describes self.cards[i].
+
+        cmc: converted mana cost
+        colors: color bits of cost and color indicator (see COLOR_BITS)
+        types: type and supertype bits (see TYPE_BITS)
+        power, toughness, loyalty: floats, NaN where not a number
+        set_codes: the sets the cards were printed in, sorted
+        rarity: a matrix with a row per card and a column per set code,
+            holding the rarity code (see RARITIES) or 0
+        rules: every card's rules text, joined by NUL characters, and
+            rules_start, the offset at which each card's text begins
+
+        The mask arguments of the methods below are boolean arrays with a
+        row per card, such as those returned by has_type, has_color and
+        in_set, or built from the columns directly, eg. table.cmc >= 5. """
+
+    def __init__(self, cards=None):
+        if cards is None:
+            cards = sorted(card.get_cards(), key=lambda c: c.name)
+        self.cards = list(cards)
+        self.index = {c.name: i for i, c in enumerate(self.cards)}
+        n = len(self.cards)
+        self.cmc = numpy.array([mana_value(c.cost) for c in self.cards],
+                               dtype=numpy.int16)
+        self.colors = numpy.array([color_mask(c) for c in self.cards],
+                                  dtype=numpy.uint8)
+        self.types = numpy.array([type_mask(c) for c in self.cards],
+                                 dtype=numpy.uint16)
+        pts = numpy.array([_pt(c) for c in self.cards],
+                          dtype=numpy.float32).reshape(n, 3)
+        self.power, self.toughness, self.loyalty = pts.T
+        self.set_codes = sorted({s for c in self.cards for s in c.sets})
+        columns = {s: j for j, s in enumerate(self.set_codes)}
+        self.rarity = numpy.zeros((n, len(self.set_codes)), dtype=numpy.uint8)
+        for i, c in enumerate(self.cards):
+            for s, r in zip(c.sets, c.set_rarities):
+                self.rarity[i, columns[s]] = _rarity_codes.get(r, 0)
+        self._columns = columns
+        self.rules = '\0'.join(c.rules for c in self.cards)
+        lengths = numpy.array([len(c.rules) + 1 for c in self.cards],
+                              dtype=numpy.int64)
+        self.rules_start = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1]))
+
+    def __len__(self):
+        return len(self.cards)
+
+    def select(self, mask):
+        """ Returns the cards selected by mask. """
+        return [self.cards[i] for i in numpy.flatnonzero(mask)]
+
+    def rules_text(self, i):
+        """ Returns the rules text of card i, from the arena. """
+        start = self.rules_start[i]
+        end = self.rules.find('\0', start)
+        return self.rules[start:] if end < 0 else self.rules[start:end]
+
+    def has_type(self, typename):
+        """ Returns a mask of the cards with the given type or supertype. """
+        return (self.types & TYPE_BITS[typename]) != 0
+
+    def has_color(self, color):
+        """ Returns a mask of the cards of the given color ('W', 'U', etc.).
+            Use self.colors == 0 for colorless cards. """
+        return (self.colors & COLOR_BITS[color]) != 0
+
+    def in_set(self, setname):
+        """ Returns a mask of the cards printed in the given set. """
+        if setname not in self._columns:
+            return numpy.zeros(len(self), dtype=bool)
+        return self.rarity[:, self._columns[setname]] != 0
+
+    def search(self, regex, flags=re.I|re.U):
+        """ Returns a mask of the cards whose rules text contains a match
+            for the given regex. Matches that cross from one card's text to
+            the next are counted for the first. """
+        starts = [m.start() for m in re.finditer(regex, self.rules, flags)]
+        mask = numpy.zeros(len(self), dtype=bool)
+        if starts:
+            mask[numpy.searchsorted(self.rules_start, starts,
+                                    side='right') - 1] = True
+        return mask
+
+    def cmc_counts(self, mask=None):
+        """ Returns an array whose ith entry is the number of cards (of those
+            selected by mask, if given) with converted mana cost i. """
+        cmc = self.cmc if mask is None else self.cmc[mask]
+        return numpy.bincount(cmc, minlength=1)
+
+    def color_counts(self, mask=None):
+        """ Returns a dict mapping each color, and None for colorless, to the
+            number of cards (selected by mask, if given) of that color. """
+        colors = self.colors if mask is None else self.colors[mask]
+        counts = {c: int(numpy.count_nonzero(colors & bit))
+                  for c, bit in COLOR_BITS.items()}
+        counts[None] = int(numpy.count_nonzero(colors == 0))
+        return counts
+
+    def rarity_counts(self, setname=None, mask=None):
+        """ Returns a dict mapping each rarity to the number of cards
+            (selected by mask, if given) printed at that rarity in the given
+            set, or in any set if none is given (so that a card printed at
+            two rarities counts for both). """
+        rarity = self.rarity if mask is None else self.rarity[mask]
+        if setname is not None:
+            if setname not in self._columns:
+                return {r: 0 for r in RARITIES}
+            counts = numpy.bincount(rarity[:, self._columns[setname]],
+                                    minlength=len(RARITIES) + 1)
+        else:
+            counts = numpy.array([numpy.count_nonzero(
+                                      (rarity == code).any(axis=1))
+                                  for code in range(len(RARITIES) + 1)])
+        return {r: int(counts[i + 1]) for i, r in enumerate(RARITIES)}
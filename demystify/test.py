@@ -27,6 +27,7 @@ import unittest
 import antlr3
 
 from grammar import DemystifyLexer, DemystifyParser
+import streams
 
 _rule_name = re.compile(r'\w+')
 
@@ -63,15 +64,18 @@ class IgnoreCaseDiffer(difflib.Differ, object):
 
 def _token_stream(name, text):
     """ Helper method for generating a token stream from text. """
-    char_stream = antlr3.ANTLRStringStream(text)
-    lexer = DemystifyLexer.DemystifyLexer(char_stream)
+    char_stream = streams.TextStream(text)
+    lexer = streams.recognizers.get(DemystifyLexer.DemystifyLexer,
+                                    char_stream)
     lexer.card = name
-    # tokenizes completely and logs on errors
-    return antlr3.CommonTokenStream(lexer)
+    ts = antlr3.CommonTokenStream(lexer)
+    # Tokenize completely (logging any errors) before the lexer is reused.
+    ts.fillBuffer()
+    return ts
 
 def parse_text(name, rule, text):
     ts = _token_stream(name, text)
-    p = DemystifyParser.DemystifyParser(ts)
+    p = streams.recognizers.get(DemystifyParser.DemystifyParser, ts, rule)
     p.setCardState(name)
     result = getattr(p, rule)()
     return result
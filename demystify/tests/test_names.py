@@ -0,0 +1,226 @@
+# This file is part of Demystify.
+#
+# Demystify: a Magic: The Gathering parser
+# Copyright (C) 2012 Benjamin S Wolf
+#
+# Demystify is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 3 of the License,
+# or (at your option) any later version.
+#
+# Demystify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Demystify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for finding and splitting card names (index.NameMatcher,
+index.NameTrie, card._subn_name and card.split_names)."""
+
+import random
+import re
+import unittest
+
+import card
+import index
+
+NAMES = [
+    'Ash', 'Ashes', 'Ash Ash', 'Aa Aa', 'Márton Stromgald', 'Márton',
+    '"Ach! Hans, Run!"', 'Will-o\'-the-Wisp', 'Fire', 'Ice', 'Fire // Ice',
+    'Borrowing 100,000 Arrows', 'Hazezon Tamar', 'Hazezon',
+    'B.F.M. (Big Furry Monster)', 'Bar_Baz',
+]
+
+def _occurrences(name, text):
+    """ Every position where name starts in text, found the slow way. """
+    found = []
+    i = text.find(name)
+    while i >= 0:
+        found.append(i)
+        i = text.find(name, i + 1)
+    return found
+
+class NameMatcherTestCase(unittest.TestCase):
+    def test_find_matches_str_find(self):
+        m = index.NameMatcher(NAMES)
+        rng = random.Random(20)
+        pieces = NAMES + [' ', ', ', 'x', '_', '.', 'A', 'Aa', 'sh', 'es']
+        for _ in range(500):
+            text = ''.join(rng.choice(pieces)
+                           for _ in range(rng.randrange(12)))
+            expected = {}
+            for name in NAMES:
+                positions = _occurrences(name, text)
+                if positions:
+                    expected[name] = positions
+            self.assertEqual(expected, m.find(text), text)
+
+    def test_contains(self):
+        m = index.NameMatcher(NAMES)
+        self.assertIn('Ash Ash', m)
+        self.assertNotIn('Ash A', m)
+        self.assertEqual(len(NAMES), len(m))
+
+class NameTrieTestCase(unittest.TestCase):
+    def is_name(self, trie, words):
+        path = trie.walk(words, 0)
+        return index.NameTrie.ends(path, len(words) - 1, words[-1])
+
+    def test_names_and_prefixes(self):
+        trie = index.NameTrie(NAMES)
+        for name in NAMES:
+            self.assertTrue(self.is_name(trie, name.split(' ')), name)
+        self.assertFalse(self.is_name(trie, ['Hazezon', 'Tam']))
+        self.assertFalse(self.is_name(trie, ['Stromgald']))
+        self.assertFalse(self.is_name(trie, ['Ash', 'Ash', 'Ash']))
+
+    def test_walk_from_start(self):
+        trie = index.NameTrie(NAMES)
+        words = ['named', 'Hazezon', 'Tamar', 'and', 'Ash']
+        path = trie.walk(words, 1)
+        # The empty prefix, 'Hazezon' and 'Hazezon Tamar'.
+        self.assertEqual(3, len(path))
+        self.assertTrue(index.NameTrie.ends(path, 0, 'Hazezon'))
+        self.assertTrue(index.NameTrie.ends(path, 1, 'Tamar'))
+        self.assertFalse(index.NameTrie.ends(path, 3, 'Ash'))
+
+    def test_add_and_discard(self):
+        trie = index.NameTrie()
+        trie.add('Serra Angel')
+        self.assertTrue(self.is_name(trie, ['Serra', 'Angel']))
+        trie.discard('Serra')
+        self.assertTrue(self.is_name(trie, ['Serra', 'Angel']))
+        trie.discard('Serra Angel')
+        self.assertFalse(self.is_name(trie, ['Serra', 'Angel']))
+
+class _NameRegistryTestCase(unittest.TestCase):
+    """ Runs each test with card's name registry holding only names. """
+    names = ()
+
+    def setUp(self):
+        self._saved = (card.all_names, card.all_shortnames,
+                       card._name_trie, card._name_matcher)
+        card.all_names = {n: card.construct_uname(n) for n in self.names}
+        card.all_shortnames = {}
+        card._name_trie = None
+        card._name_matcher = None
+
+    def tearDown(self):
+        (card.all_names, card.all_shortnames,
+         card._name_trie, card._name_matcher) = self._saved
+
+class SubnNameTestCase(_NameRegistryTestCase):
+    names = NAMES
+
+    def check(self, name, line):
+        expected = re.subn(r'\b{}(?!\w)'.format(name), 'SELF', line)
+        found = card.get_name_matcher().find(line)
+        self.assertEqual(expected, card._subn_name(name, 'SELF', line, found),
+                         '{!r} in {!r}'.format(name, line))
+
+    def test_boundaries(self):
+        cases = [
+            ('Ash', 'Ash'),
+            ('Ash', 'Ash deals 2 damage.'),
+            ('Ash', 'Sacrifice Ash'),
+            ('Ash', 'Ashes to Ash.'),
+            ('Ash', 'Ash_ is not Ash2 or xAsh.'),
+            ('Ash', 'Ash, Ash, and Ash'),
+            ('Ash Ash', 'Ash Ash Ash Ash'),
+            ('Aa Aa', 'Aa Aa Aa'),
+            ('Márton', 'Márton Stromgald and Mártonx'),
+            ('Márton Stromgald', 'Márton Stromgald gets +1/+1.'),
+            # A name that starts with a non-word character must follow one.
+            ('"Ach! Hans, Run!"', '"Ach! Hans, Run!" x"Ach! Hans, Run!"'),
+            ('"Ach! Hans, Run!"', ' "Ach! Hans, Run!"!'),
+            ('Will-o\'-the-Wisp', 'Will-o\'-the-Wisp blocks.'),
+            ('Borrowing 100,000 Arrows', 'Borrowing 100,000 Arrows deals'),
+            ('Bar_Baz', 'Bar_Baz and Bar_Bazz'),
+            ('Ice', 'Fire // Ice'),
+        ]
+        for name, line in cases:
+            self.check(name, line)
+
+    def test_regex_names_and_unknown_names(self):
+        # Names with regex metacharacters, and names the matcher was built
+        # without, go to re.
+        self.check('B.F.M. (Big Furry Monster)', 'B.F.M. (Big Furry Monster)')
+        self.check('Unknown', 'Unknown attacks.')
+        self.assertEqual(('SELF', 1),
+                         card._subn_name('Ash', 'SELF', 'Ash', None))
+
+    def test_random_lines(self):
+        rng = random.Random(21)
+        pieces = NAMES + [' ', ', ', '.', 'x', '_', '2', 'é', '+']
+        for _ in range(500):
+            line = ''.join(rng.choice(pieces)
+                           for _ in range(rng.randrange(10)))
+            for name in NAMES:
+                if not card._regex_special.search(name):
+                    self.check(name, line)
+
+class SplitNamesTestCase(_NameRegistryTestCase):
+    names = [
+        'Hazezon Tamar', 'Hazezon', 'Fire', 'Ice', 'Fire and Ice',
+        'Life and Limb', 'Life', 'Limb', 'Boom', 'Bust', 'Boom or Bust',
+        'Sword of Fire and Ice', 'Kiki-Jiki, Mirror Breaker', 'Kiki-Jiki',
+        'Hit', 'Run', 'Hit, Run', 'Rise of the Dark Realms',
+    ]
+
+    def potential(self, words, cardnames):
+        """ split_names, the way it was done with potential_names. """
+        good = []
+        names = None
+        for names in card.potential_names(words, cardnames):
+            if all(name in card.all_names for name in names):
+                good.append(names)
+        return good, names
+
+    def check(self, text, cardnames=()):
+        words = text.split()
+        self.assertEqual(self.potential(words, cardnames),
+                         card.split_names(words, cardnames), text)
+
+    def test_splits(self):
+        cases = [
+            'Hazezon Tamar gets +1/+1.',
+            'Fire and Ice deals 2 damage.',
+            'Life and Limb, Boom or Bust, and Hazezon Tamar.',
+            'Sword of Fire and Ice and Fire or Ice:',
+            'Kiki-Jiki, Mirror Breaker and Hazezon',
+            'Hit, Run, and Fire',
+            'Hit, Run, Boom, and Bust or Ice',
+            'Rise of the Dark Realms.',
+            'Nobody Knows Me',
+            'Boom, and Bust',
+            'Fire."',
+        ]
+        for text in cases:
+            self.check(text)
+            self.check(text, ('Bust', 'Hazezon'))
+
+    def test_random_runs(self):
+        rng = random.Random(22)
+        words = ['Hazezon', 'Tamar', 'Fire', 'Ice', 'Life', 'Limb', 'Boom',
+                 'Bust', 'Hit,', 'Run,', 'Fire,', 'Ice,', 'and', 'or', 'of',
+                 'the', 'Nobody', 'Ice.', 'Bust:', 'Kiki-Jiki,', 'Mirror',
+                 'Breaker']
+        for _ in range(2000):
+            text = ' '.join([rng.choice(words[:8])]
+                            + [rng.choice(words)
+                               for _ in range(rng.randrange(8))]
+                            + ['gets', '+1/+1.'])
+            cardnames = tuple(rng.sample(self.names, rng.randrange(3)))
+            self.check(text, cardnames)
+
+    def test_refs(self):
+        refs = {}
+        card.split_names('Hazezon Tamar and Nobody'.split(), (), refs)
+        self.assertTrue(refs['Hazezon Tamar and Nobody'] is False)
+        self.assertTrue(refs['Hazezon Tamar'])
+        self.assertFalse(refs['Nobody'])
+
+if __name__ == '__main__':
+    unittest.main()
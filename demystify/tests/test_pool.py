@@ -0,0 +1,67 @@
+# This file is part of Demystify.
+#
+# Demystify: a Magic: The Gathering parser
+# Copyright (C) 2012 Benjamin S Wolf
+#
+# Demystify is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 3 of the License,
+# or (at your option) any later version.
+#
+# Demystify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Demystify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the card pool and the state it sends its workers."""
+
+import types
+import unittest
+
+import card
+
+# Module state that the workers are sent.
+suffix = None
+
+def _set_suffix(value):
+    global suffix
+    suffix = value
+
+@card.uses_fields('name')
+def add_suffix(c):
+    return c.name, c.name + suffix
+
+class CardPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        card.worker_state('test suffix', lambda: suffix, lambda: suffix,
+                          _set_suffix)
+        self.cards = [types.SimpleNamespace(name='Card {}'.format(i))
+                      for i in range(20)]
+
+    def tearDown(self):
+        del card._worker_states['test suffix']
+        card.shutdown_pool()
+
+    def run_pool(self, func):
+        return list(card.imap_multi(func, self.cards, processes=2,
+                                    ordered=True))
+
+    def test_state_sent_when_changed(self):
+        _set_suffix('!')
+        self.assertEqual([(c.name, c.name + '!') for c in self.cards],
+                         self.run_pool(add_suffix))
+        _set_suffix('?')
+        self.assertEqual([(c.name, c.name + '?') for c in self.cards],
+                         self.run_pool(add_suffix))
+
+    def test_unpicklable_function(self):
+        _set_suffix('.')
+        func = card.uses_fields('name')(lambda c: (c.name, c.name + suffix))
+        self.assertEqual([(c.name, c.name + '.') for c in self.cards],
+                         self.run_pool(func))
+
+if __name__ == '__main__':
+    unittest.main()
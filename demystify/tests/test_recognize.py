@@ -0,0 +1,106 @@
+# This file is part of Demystify.
+#
+# Demystify: a Magic: The Gathering parser
+# Copyright (C) 2012 Benjamin S Wolf
+#
+# Demystify is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 3 of the License,
+# or (at your option) any later version.
+#
+# Demystify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Demystify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for recognize.strip_grammar."""
+
+import unittest
+
+import recognize
+
+PARSER_GRAMMAR = r"""parser grammar small;
+
+options {
+    output = AST;
+}
+
+@members {
+    def isWord(self, s):
+        return s in {'a': 1}  # a '}' in a comment
+}
+
+// A rule with labels, operators and rewrites.
+subset : n=number? p+=props (COMMA p+=props)* -> ^(SUBSET $n? $p+)
+       | THE^ props! { self.seen = '}' }
+       | {self.isWord("x")}? WORD -> WORD
+       ;
+
+props : ( options {greedy=true;}: prop )+ -> ^(PROPERTIES prop+) ;
+
+number : a=NUMBER -> NUMBER[$a, "n"] | x='one' -> ;
+"""
+
+STRIPPED_PARSER_GRAMMAR = r"""parser grammar small;
+
+options {
+}
+
+@members {
+    def isWord(self, s):
+        return s in {'a': 1}  # a '}' in a comment
+}
+
+// A rule with labels, operators and rewrites.
+subset : number? props (COMMA props)* | THE props
+       | {self.isWord("x")}? WORD ;
+
+props : ( options {greedy=true;}: prop )+ ;
+
+number : NUMBER | 'one' ;
+"""
+
+class StripGrammarTestCase(unittest.TestCase):
+    def test_parser_grammar(self):
+        # Whatever is taken out leaves the spaces around it behind.
+        stripped = recognize.strip_grammar(PARSER_GRAMMAR)
+        self.assertEqual(STRIPPED_PARSER_GRAMMAR.split('\n'),
+                         [line.rstrip() for line in stripped.split('\n')])
+
+    def test_combined_grammar_keeps_lexer_rules(self):
+        text = ("grammar G;\n"
+                "options { output = AST; language = Python3; }\n"
+                "r : a=ID^ (b+=ID!)* -> ^($a $b*) ;\n"
+                "ID : ('a'..'z')+ { self.x = 1 } ;\n"
+                "WS : ' ' { $channel=HIDDEN } ;\n")
+        self.assertEqual("grammar G;\n"
+                         "options { language = Python3; }\n"
+                         "r : ID (ID)* ;\n"
+                         "ID : ('a'..'z')+ { self.x = 1 } ;\n"
+                         "WS : ' ' { $channel=HIDDEN } ;\n",
+                         recognize.strip_grammar(text))
+
+    def test_literals_and_comments_untouched(self):
+        # Operators, arrows and braces inside literals and comments aren't
+        # grammar syntax.
+        text = ("parser grammar p;\n"
+                "r : '^' '!' '->' /* x=y -> ^(z) */ '{' s ; // t!^\n")
+        self.assertEqual(text, recognize.strip_grammar(text))
+
+    def test_rewrite_inside_block(self):
+        text = "parser grammar p;\nr : ( a -> ^(A a) | b ) c ;\n"
+        self.assertEqual("parser grammar p;\nr : ( a | b ) c ;\n",
+                         recognize.strip_grammar(text))
+
+    def test_predicates_kept(self):
+        text = ("parser grammar p;\n"
+                "r : { self.x(')') }? a { act() } | (b)=> b ;\n")
+        self.assertEqual("parser grammar p;\n"
+                         "r : { self.x(')') }? a  | (b)=> b ;\n",
+                         recognize.strip_grammar(text))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+# This file is part of Demystify.
+#
+# Demystify: a Magic: The Gathering parser
+# Copyright (C) 2012 Benjamin S Wolf
+#
+# Demystify is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 3 of the License,
+# or (at your option) any later version.
+#
+# Demystify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Demystify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests that the rule stack the parser keeps when built with -trace gives
+the same error messages as walking the interpreter stack."""
+
+import unittest
+
+try:
+    import antlr3
+    import demystify
+except ImportError:
+    # The antlr3 runtime, or the generated grammar, isn't there.
+    demystify = None
+
+import logs
+
+# (rule, text) pairs, some of which fail to parse in various places.
+SAMPLES = [
+    ('triggers', 'SELF enters the battlefield'),
+    ('triggers', 'a creature you control dies'),
+    ('triggers', 'SELF deals combat damage to a player or'),
+    ('triggers', 'an opponent casts a blue spell during your turn'),
+    ('triggers', 'you frobnicate a permanent'),
+    ('keywords', 'flying, first strike'),
+    ('keywords', 'flying, frobnicate'),
+    ('keywords', 'protection from red and from'),
+    ('cost', '{t}, sacrifice a creature'),
+    ('cost', '{2}{u}, return SELF to its owner\'s hand and then'),
+    ('cost', 'pay 3 life, , {t}'),
+]
+
+@unittest.skipUnless(demystify, 'needs antlr3 and the generated parser')
+class RuleStackTestCase(unittest.TestCase):
+    def setUp(self):
+        # Keep the parser's errors off the console.
+        demystify.plog.removeHandler(demystify._stdout)
+
+    def tearDown(self):
+        antlr3.Parser.FAST_RULE_STACK = True
+        demystify.plog.addHandler(demystify._stdout)
+
+    def run_samples(self, fast):
+        """ Returns the messages the parser logs for the samples, and the
+            rule stack at the first error in each, as fail-fast mode
+            finds it. """
+        antlr3.Parser.FAST_RULE_STACK = fast
+        with logs.capture('Parser') as records:
+            for rule, text in SAMPLES:
+                p, _ = demystify._parse(rule, text, 'Sample')
+                if fast and getattr(p._state, 'ruleStack', None) is None:
+                    self.skipTest('the parser was not built with -trace')
+        stacks = []
+        for rule, text in SAMPLES:
+            f = demystify._scan_parse(rule, text, 'Sample', memoize=False)
+            stacks.append(f and f.stack)
+        return [r.getMessage() for r in records], stacks
+
+    def test_same_messages_and_stacks(self):
+        messages, stacks = self.run_samples(False)
+        self.assertTrue(messages, 'none of the samples failed to parse')
+        fast_messages, fast_stacks = self.run_samples(True)
+        self.assertEqual(messages, fast_messages)
+        self.assertEqual(stacks, fast_stacks)
+
+if __name__ == '__main__':
+    unittest.main()
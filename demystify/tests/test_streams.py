@@ -0,0 +1,125 @@
+# This file is part of Demystify.
+#
+# Demystify: a Magic: The Gathering parser
+# Copyright (C) 2012 Benjamin S Wolf
+#
+# Demystify is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 3 of the License,
+# or (at your option) any later version.
+#
+# Demystify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Demystify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for streams.TextStream against antlr3.ANTLRStringStream."""
+
+import random
+import unittest
+
+try:
+    import antlr3
+    import streams
+except ImportError:
+    # The antlr3 runtime isn't there.
+    antlr3 = None
+
+TEXT = ('Flying\nWhen Márton Stromgald enters the battlefield, '
+        'tap {2/W}.\n\n—Kicker {G}\n')
+
+@unittest.skipUnless(antlr3, 'needs antlr3')
+class TextStreamTestCase(unittest.TestCase):
+    def state(self, s, line_offset=0):
+        la = [s.LA(i) for i in (1, 2, 3)]
+        lt = [s.LT(i) for i in (0, 1, 2)]
+        if s.index() > 0:
+            la.append(s.LA(-1))
+            lt.append(s.LT(-1))
+        return (s.index(), s.size(), s.getLine() - line_offset,
+                s.getCharPositionInLine(), la, lt)
+
+    def check_ops(self, start, stop, line, seed):
+        """ Runs the same random operations on a TextStream over
+            TEXT[start:stop] and an ANTLRStringStream over that text,
+            comparing them after each one. """
+        rng = random.Random(seed)
+        text = TEXT[start:stop]
+        expected = antlr3.ANTLRStringStream(text)
+        actual = streams.TextStream(TEXT, start, stop, line=line)
+        offset = line - 1
+        self.assertEqual(self.state(expected), self.state(actual, offset))
+        for _ in range(300):
+            op = rng.choice(['consume'] * 4 + ['mark', 'rewind', 'release',
+                                               'seek', 'substring'])
+            if op == 'consume':
+                expected.consume()
+                actual.consume()
+            elif op == 'mark':
+                self.assertEqual(expected.mark(), actual.mark())
+            elif op == 'rewind' and expected.markDepth:
+                if rng.random() < 0.5:
+                    marker = rng.randint(1, expected.markDepth)
+                    expected.rewind(marker)
+                    actual.rewind(marker)
+                else:
+                    expected.rewind()
+                    actual.rewind()
+            elif op == 'release' and expected.markDepth:
+                marker = rng.randint(1, expected.markDepth)
+                expected.release(marker)
+                actual.release(marker)
+            elif op == 'seek':
+                # ANTLRStringStream never returns from seeking past its end.
+                i = rng.randint(0, len(text))
+                expected.seek(i)
+                actual.seek(i)
+            elif op == 'substring' and text:
+                a = rng.randrange(len(text))
+                b = rng.randrange(a, len(text))
+                self.assertEqual(expected.substring(a, b),
+                                 actual.substring(a, b))
+            self.assertEqual(expected.markDepth, actual.markDepth)
+            self.assertEqual(self.state(expected),
+                             self.state(actual, offset), op)
+
+    def test_whole_text(self):
+        for seed in range(20):
+            self.check_ops(0, None, 1, seed)
+
+    def test_slices(self):
+        rng = random.Random(30)
+        for seed in range(50):
+            start = rng.randint(0, len(TEXT))
+            stop = rng.randint(start, len(TEXT))
+            self.check_ops(start, stop, rng.randint(1, 5), seed)
+
+    def test_shared_code_points(self):
+        codes = streams.code_points(TEXT)
+        lines = TEXT.split('\n')
+        start = 0
+        for line in lines:
+            stop = start + len(line)
+            s = streams.TextStream(TEXT, start, stop, codes)
+            chars = []
+            while s.LA(1) != antlr3.EOF:
+                chars.append(s.LT(1))
+                s.consume()
+            self.assertEqual(line, ''.join(chars))
+            self.assertEqual(line, s.substring(0, len(line) - 1))
+            start = stop + 1
+
+    def test_line_numbers(self):
+        s = streams.TextStream(TEXT, TEXT.index('When'), line=2)
+        self.assertEqual(2, s.getLine())
+        s.seek(TEXT.index('\n', TEXT.index('When')) + 1
+               - TEXT.index('When'))
+        self.assertEqual((3, 0), (s.getLine(), s.getCharPositionInLine()))
+        s.reset()
+        self.assertEqual((2, 0), (s.getLine(), s.getCharPositionInLine()))
+
+if __name__ == '__main__':
+    unittest.main()